@@ -0,0 +1,132 @@
+"""Cold and warm start benchmark for the OAuth Lambda handler.
+
+Every run starts a fresh Python process, as Lambda does for a new execution
+environment, and measures:
+
+-   `import`: loading lambda_function with requests and pymongo, which
+    Lambda does during init.
+-   `cold`: the first invocation, which opens the connections to the token
+    endpoint and MongoDB.
+-   `warm`: the following invocations, reusing those connections.
+-   `after_idle`: one more invocation after `--idle` seconds without traffic.
+
+The Twitch token endpoint is replaced by a local server answering after
+`--token-latency` seconds. MongoDB is real: point MONGODB_CONNECTION_STRING
+(or `--mongo`) at a test database, as the handler upserts `config.twitch_user_tokens`.
+
+    python cold_start_benchmark.py --mongo mongodb://localhost:27017 --runs 5 --idle 30
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_here = os.path.dirname(os.path.abspath(__file__))
+
+
+class _TokenHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, as id.twitch.tv
+    disable_nagle_algorithm = True
+    latency = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.latency)
+        body = json.dumps({'access_token': 'access', 'refresh_token': 'refresh', 'expires_in': 14400}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def invoke(handler):
+    event = {'body': json.dumps({'client_id': 'benchmark', 'client_secret': 'benchmark', 'code': 'code'})}
+    started = time.perf_counter()
+    response = handler(event, None)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if response['statusCode'] != 200:
+        raise RuntimeError(f"Handler failed: {response['body']}")
+    return elapsed_ms
+
+
+def run_environment(warm, idle):
+    """Body of one benchmark process: import, then invoke the handler."""
+    sys.path.insert(0, _here)
+    started = time.perf_counter()
+    import lambda_function
+    result = {'import': (time.perf_counter() - started) * 1000}
+    result['cold'] = invoke(lambda_function.lambda_handler)
+    result['warm'] = [invoke(lambda_function.lambda_handler) for _ in range(warm)]
+    if idle:
+        time.sleep(idle)
+        result['after_idle'] = invoke(lambda_function.lambda_handler)
+    print(json.dumps(result))
+
+
+def summary(values):
+    values = sorted(values)
+    if not values:
+        return 'n/a'
+    return f"p50 {values[len(values) // 2]:.1f} ms, max {values[-1]:.1f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes, i.e. cold starts')
+    parser.add_argument('--warm', type=int, default=20, help='warm invocations per process')
+    parser.add_argument('--idle', type=float, default=0, help='seconds to wait before one more invocation')
+    parser.add_argument('--token-latency', type=float, default=0.1, help='seconds per token endpoint call')
+    parser.add_argument('--mongo', default=os.environ.get('MONGODB_CONNECTION_STRING', 'mongodb://localhost:27017'))
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    parser.add_argument('--environment', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.environment:
+        run_environment(args.warm, args.idle)
+        return
+
+    _TokenHandler.latency = args.token_latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _TokenHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    env = dict(
+        os.environ,
+        TWITCH_TOKEN_URL=f'http://127.0.0.1:{server.server_address[1]}/oauth2/token',
+        FRONTEND_CALLBACK_URL='http://localhost/auth_callback.html',
+        MONGODB_CONNECTION_STRING=args.mongo,
+        PYTHONDONTWRITEBYTECODE='1'
+    )
+    command = [sys.executable, os.path.abspath(__file__), '--environment',
+               '--warm', str(args.warm), '--idle', str(args.idle)]
+    results = []
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        output = subprocess.run(command, env=env, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        result['process'] = (time.perf_counter() - started) * 1000
+        results.append(result)
+    server.shutdown()
+
+    print(f"{args.runs} cold starts, {args.warm} warm invocations each, token endpoint {args.token_latency * 1000:.0f} ms")
+    print(f"  import:     {summary([result['import'] for result in results])}")
+    print(f"  cold:       {summary([result['cold'] for result in results])}")
+    print(f"  warm:       {summary([value for result in results for value in result['warm']])}")
+    if args.idle:
+        print(f"  after idle: {summary([result['after_idle'] for result in results])} ({args.idle:.0f}s idle)")
+    print(f"  process:    {summary([result['process'] for result in results])} (including interpreter start)")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,64 @@
 import json
 import os
 import time
-import boto3
-from pymongo import MongoClient
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+# The clients below are created once per execution environment and reused by warm invocations.
+# Worst case within the 10 second Lambda timeout: 1.5 + 1.5 + 2.5 s for the token exchange (one
+# connect retry), then 1.5 s of server selection and 1.5 s of socket timeout for the upsert.
+TOKEN_URL = os.environ.get('TWITCH_TOKEN_URL', 'https://id.twitch.tv/oauth2/token')
+TOKEN_TIMEOUT = (1.5, 2.5)  # Connect and read timeouts
+TOKEN_CONNECT_RETRIES = 1
+MONGO_TIMEOUT_MS = 1500
+
+_http_session = None
+_mongo_client = None
+
+
+def get_http_session():
+    """Keep-alive session to the Twitch token endpoint."""
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+        # Only connection failures are retried: an authorization code can be redeemed once
+        retry = Retry(total=TOKEN_CONNECT_RETRIES, connect=TOKEN_CONNECT_RETRIES, read=0, status=0)
+        _http_session.mount('https://', HTTPAdapter(max_retries=retry))
+    return _http_session
+
+
+def get_config_collection():
+    """The `config` collection, on a MongoClient shared by warm invocations.
+
+    Creating the client starts the connection and TLS handshake to Atlas on a
+    background thread, so calling this before the token exchange overlaps the two.
+    """
+    global _mongo_client
+    if _mongo_client is None:
+        _mongo_client = MongoClient(
+            os.environ['MONGODB_CONNECTION_STRING'],
+            maxPoolSize=1,                            # One invocation at a time per environment
+            maxIdleTimeMS=60000,                      # Sockets idle while the environment was frozen are not reused
+            serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+            connectTimeoutMS=MONGO_TIMEOUT_MS,
+            socketTimeoutMS=MONGO_TIMEOUT_MS,
+            retryWrites=False                         # A retry would not fit in the Lambda timeout
+        )
+    return _mongo_client['patrolia']['config']
+
+
+def json_response(status_code, body):
+    return {
+        'statusCode': status_code,
+        'body': json.dumps(body),
+        'headers': {
+            'Content-Type': 'application/json'
+        }
+    }
+
 
 def lambda_handler(event, context):
     try:
@@ -13,19 +68,15 @@ def lambda_handler(event, context):
         client_secret = body['client_secret']
         auth_code = body['code']
     except (json.JSONDecodeError, KeyError) as e:
-        return {
-            'statusCode': 400,
-            'body': json.dumps({'error': 'Invalid request body'}),
-            'headers': {
-                'Content-Type': 'application/json'
-            }
-        }
+        return json_response(400, {'error': 'Invalid request body'})
+
+    # Connect to MongoDB while the authorization code is exchanged
+    config_collection = get_config_collection()
 
     # Ensure the redirect_uri matches the frontend's callback URL
     redirect_uri = os.environ['FRONTEND_CALLBACK_URL']  # Preconfigured in Terraform
 
     # Exchange the authorization code for tokens
-    token_url = "https://id.twitch.tv/oauth2/token"
     payload = {
         'client_id': client_id,
         'client_secret': client_secret,
@@ -34,15 +85,13 @@ def lambda_handler(event, context):
         'redirect_uri': redirect_uri
     }
 
-    response = requests.post(token_url, data=payload)
-    if response.status_code != 200:
-        return {
-            'statusCode': 500,
-            'body': json.dumps({'error': 'Failed to exchange authorization code.'}),
-            'headers': {
-                'Content-Type': 'application/json'
-            }
-        }
+    try:
+        response = get_http_session().post(TOKEN_URL, data=payload, timeout=TOKEN_TIMEOUT)
+    except Exception as e:
+        print(f"Token exchange failed: {e}")
+        response = None
+    if response is None or response.status_code != 200:
+        return json_response(500, {'error': 'Failed to exchange authorization code.'})
 
     # Parse token response
     token_data = response.json()
@@ -51,30 +100,23 @@ def lambda_handler(event, context):
     expires_in = token_data['expires_in']
 
     # Update MongoDB with the new tokens
-    mongo_uri = os.environ['MONGODB_CONNECTION_STRING']
-    client = MongoClient(mongo_uri)
-    db = client['patrolia']
-    config_collection = db['config']
-
-    config_collection.update_one(
-        {'_id': 'twitch_user_tokens'},
-        {
-            '$set': {
-                'client_id': client_id,
-                'client_secret': client_secret,
-                'access_token': access_token,
-                'refresh_token': refresh_token,
-                'expires_in': expires_in,
-                'obtained_at': int(time.time())
-            }
-        },
-        upsert=True
-    )
+    try:
+        config_collection.update_one(
+            {'_id': 'twitch_user_tokens'},
+            {
+                '$set': {
+                    'client_id': client_id,
+                    'client_secret': client_secret,
+                    'access_token': access_token,
+                    'refresh_token': refresh_token,
+                    'expires_in': expires_in,
+                    'obtained_at': int(time.time())
+                }
+            },
+            upsert=True
+        )
+    except PyMongoError as e:
+        print(f"Storing tokens failed: {e}")
+        return json_response(500, {'error': 'Failed to store tokens.'})
 
-    return {
-        'statusCode': 200,
-        'body': json.dumps({'message': 'Tokens successfully updated in MongoDB. You can now close this window.'}),
-        'headers': {
-            'Content-Type': 'application/json'
-        }
-    }
+    return json_response(200, {'message': 'Tokens successfully updated in MongoDB. You can now close this window.'})
@@ -22,6 +22,19 @@ resource "aws_sqs_queue" "output_queue" {
   visibility_timeout_seconds = 30
 }
 
+# Queues of the extra channel shards: twitch-input-queue-1, twitch-output-queue-1, ...
+resource "aws_sqs_queue" "input_queue_shard" {
+  count                      = var.shard_count - 1
+  name                       = "twitch-input-queue-${count.index + 1}"
+  visibility_timeout_seconds = 30
+}
+
+resource "aws_sqs_queue" "output_queue_shard" {
+  count                      = var.shard_count - 1
+  name                       = "twitch-output-queue-${count.index + 1}"
+  visibility_timeout_seconds = 30
+}
+
 # SSM Parameters for SQS Queue URLs
 resource "aws_ssm_parameter" "sqs_input_queue_url" {
   name  = "/patroliaaws/input_queue_url"
@@ -310,11 +323,13 @@ resource "aws_s3_object" "auth_callback_html" {
 # 9. Lambda Function
 resource "aws_lambda_function" "oauth_handler" {
   filename         = "lambda_function.zip"  # The deployment package
+  source_code_hash = filebase64sha256("lambda_function.zip")
   function_name    = "${var.project_name}_oauth_handler"
   role             = aws_iam_role.lambda_role.arn
   handler          = "lambda_function.lambda_handler"
   runtime          = "python3.11"
   timeout          = 10
+  memory_size      = 512  # CPU scales with memory; 128 MB makes imports and TLS handshakes slow
   publish          = true
 
   layers = [
@@ -40,3 +40,9 @@ variable "key_pair_name" {
   description = "Name of the AWS EC2 Key Pair."
   type        = string
 }
+
+variable "shard_count" {
+  description = "Number of channel shards; each shard has its own input and output queues."
+  type        = number
+  default     = 1
+}
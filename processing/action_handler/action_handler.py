@@ -2,19 +2,572 @@ import os
 import boto3
 import json
 import time
+import calendar
+import random
+import signal
 import asyncio
+import threading
+import aiohttp
+from collections import Counter, OrderedDict, deque
 from twitchAPI.twitch import Twitch
-from twitchAPI.oauth import refresh_access_token
 from twitchAPI.type import AuthScope
 from pymongo import MongoClient
+from common import metrics, logs, envelope
+from common.aio import run_blocking, reserve_io_workers, LoopLagMonitor
+from common.snapshot import Snapshot, SNAPSHOT_INTERVAL
+from common.autoscale import Autoscaler, AUTOSCALE, AUTOSCALE_INTERVAL
+from common.sharding import SHARD_INDEX, open_shard_transport, configured_channels
+from common.transport import VisibilityKeeper
+from common.tokens import refresh_delay, refresh_user_tokens, refresh_token_if_needed
 import logging
 
 # Set up logging configuration
-logging.basicConfig(
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.INFO  # You can change this to DEBUG, ERROR, etc.
-)
+logs.setup('action_handler')
 logger = logging.getLogger()
+event_log = logs.category('events')
+batch_log = logs.category('batches')
+action_log = logs.category('actions')
+
+# Batch workers; the pool is resized between the bounds from the depth of the output queue
+ACTION_WORKERS = int(os.environ.get('ACTION_WORKERS', '1'))
+MIN_ACTION_WORKERS = int(os.environ.get('ACTION_MIN_WORKERS', '1'))
+MAX_ACTION_WORKERS = int(os.environ.get('ACTION_MAX_WORKERS', '4'))
+
+# Each worker holds an executor thread while long polling, so leave room for the other calls
+reserve_io_workers(MAX_ACTION_WORKERS)
+
+# Transport the eligibility results arrive on: 'sqs' (default), 'memory:<name>' or 'dir:<path>'
+OUTPUT_TRANSPORT = os.environ.get('OUTPUT_TRANSPORT', 'sqs')
+VISIBILITY_TIMEOUT = int(os.environ.get('OUTPUT_VISIBILITY_TIMEOUT', '30'))  # Matches infra/main.tf
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9103'))  # 0 disables the metrics endpoint
+
+# Login -> user_id resolution cache
+USER_ID_CACHE_TTL = int(os.environ.get('USER_ID_CACHE_TTL', str(24 * 3600)))
+USER_ID_CACHE_MAX_ENTRIES = int(os.environ.get('USER_ID_CACHE_MAX_ENTRIES', '20000'))
+USER_NOT_FOUND_TTL = 300  # Logins that do not exist are cached briefly as None
+GET_USERS_MAX_LOGINS = 100  # Helix limit for a single get_users call
+_MISSING = object()
+
+# Enforcement ledger
+TIMEOUT_DURATION = 36000  # 10 hours
+LEDGER_EXPIRY_MARGIN = 60  # Re-enforce slightly before Twitch lifts the timeout
+LEDGER_STALE_GRACE = 5  # A message this long after a timeout proves it was lifted early
+DELETED_MESSAGE_TTL = 600  # Remember deleted messages long enough to ignore redeliveries
+
+def parse_event_time(timestamp):
+    """Convert an event timestamp ('%Y-%m-%dT%H:%M:%SZ') to epoch seconds."""
+    try:
+        return calendar.timegm(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ"))
+    except (TypeError, ValueError):
+        return None
+
+class EnforcementLedger:
+    """Records active enforcement actions so repeated ones collapse into a single API call."""
+
+    def __init__(self):
+        self._active = {}     # (login, action) -> (applied_at, expires_at) as wall clock times
+        self._in_flight = {}  # (login, action) -> task performing the API call
+        self.stats = {'applied': 0, 'coalesced': 0, 'stale': 0}
+
+    def is_active(self, login, action, message_time=None):
+        """Return whether the action is already applied or being applied to the user.
+
+        A chat message sent after the action was applied proves it was lifted
+        (e.g. a moderator removed the timeout), so the entry is dropped.
+        """
+        key = (login.lower(), action)
+        if key in self._in_flight:
+            return True
+        entry = self._active.get(key)
+        if entry is None:
+            return False
+        applied_at, expires_at = entry
+        if expires_at <= time.time():
+            del self._active[key]
+            return False
+        if message_time is not None and message_time > applied_at + LEDGER_STALE_GRACE:
+            logger.warning(f"{login} is chatting despite an active {action}; enforcing again.")
+            self.stats['stale'] += 1
+            del self._active[key]
+            return False
+        return True
+
+    async def run_once(self, login, action, duration, call, message_time=None):
+        """Await `call()` unless the same action is already active or in flight for the user.
+
+        Returns True if the API call was made by this invocation.
+        """
+        if self.is_active(login, action, message_time):
+            self.stats['coalesced'] += 1
+            return False
+        key = (login.lower(), action)
+        task = asyncio.ensure_future(call())
+        self._in_flight[key] = task
+        try:
+            await task
+        finally:
+            del self._in_flight[key]
+        now = time.time()
+        self._active[key] = (now, now + duration - LEDGER_EXPIRY_MARGIN)
+        self.stats['applied'] += 1
+        return True
+
+    def in_flight(self, login, action):
+        """Return the task applying the action to the user, or None."""
+        return self._in_flight.get((login.lower(), action))
+
+    def state(self):
+        """Active actions as [login, action, applied_at, expires_at]."""
+        return [[login, action, applied_at, expires_at]
+                for (login, action), (applied_at, expires_at) in self._active.items()]
+
+    def restore(self, entries):
+        now = time.time()
+        for login, action, applied_at, expires_at in entries:
+            if expires_at > now:
+                self._active[login, action] = (applied_at, expires_at)
+        if self._active:
+            logger.info(f"Restored {len(self._active)} active enforcement actions.")
+
+    def covers(self, login, action, sent_at):
+        """Return whether the action was applied to the user after `sent_at` and is still active."""
+        entry = self._active.get((login.lower(), action))
+        return entry is not None and entry[0] >= sent_at and entry[1] > time.time()
+
+    def prune(self):
+        """Forget actions that have expired."""
+        now = time.time()
+        for key in [key for key, (_, expires_at) in self._active.items() if expires_at <= now]:
+            del self._active[key]
+
+# Action scheduler
+HELIX_BASE_URL = os.environ.get('HELIX_BASE_URL', 'https://api.twitch.tv/helix/')  # Point at a fake Helix to benchmark
+HELIX_POINTS_PER_MINUTE = 800  # Default Helix bucket for user access tokens
+HELIX_INITIAL_POINTS = 5  # Burst allowed before the first Ratelimit-* headers give the real bucket
+ACTION_CONCURRENCY = int(os.environ.get('ACTION_CONCURRENCY', '20'))
+ACTION_MAX_RETRIES = 5
+
+# Priority lanes: calls for chat messages go before calls for joins, which keep a minimum share of the points
+LANE_MESSAGE = 'message'
+LANE_JOIN = 'join'
+JOIN_MIN_SHARE = float(os.environ.get('ACTION_JOIN_MIN_SHARE', '0.2'))
+
+class HelixError(Exception):
+    """Raised when Helix rejects a moderation request."""
+
+    def __init__(self, status, message):
+        super().__init__(f"Helix returned {status}: {message}")
+        self.status = status
+        self.message = message
+
+class TokenBucket:
+    """Client-side view of the Helix rate-limit bucket, corrected by the Ratelimit-* headers.
+
+    The bucket is shared with every other client of the token, so it starts
+    with a small burst and only takes the real size and level from the first
+    response. Points of requests still in flight are not yet counted in
+    Ratelimit-Remaining, so they are subtracted from it.
+    """
+
+    def __init__(self, capacity=HELIX_INITIAL_POINTS, refill_per_second=HELIX_POINTS_PER_MINUTE / 60):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.in_flight = 0  # Points taken by requests without a response yet
+        self._synced = False
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.refill_per_second)
+        self._updated = now
+
+    async def acquire(self):
+        """Wait until a request may be sent and take a point for it."""
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._blocked_until:
+                await asyncio.sleep(self._blocked_until - now)
+            elif self.tokens >= 1:
+                self.tokens -= 1
+                self.in_flight += 1
+                return
+            else:
+                await asyncio.sleep((1 - self.tokens) / self.refill_per_second)
+
+    def settle(self, headers=None):
+        """Mark a request that took a point as finished, and align with its response headers if any."""
+        self.in_flight = max(0, self.in_flight - 1)
+        if headers is not None:
+            self.observe(headers)
+
+    def observe(self, headers):
+        """Align the bucket with the Ratelimit-Limit/Remaining headers of a response.
+
+        Helix refills Ratelimit-Limit points per minute. Ratelimit-Reset only
+        has a one second resolution, too coarse to derive the rate from.
+        """
+        try:
+            limit = int(headers['Ratelimit-Limit'])
+            remaining = int(headers['Ratelimit-Remaining'])
+        except KeyError:
+            return
+        except ValueError:
+            logger.warning(f"Ignoring malformed rate-limit headers: {dict(headers)}")
+            return
+        now = time.monotonic()
+        self._refill(now)
+        self.capacity = limit
+        self.refill_per_second = limit / 60
+        available = remaining - self.in_flight
+        if self._synced:
+            # Responses can arrive out of order, so a higher Remaining is not trusted
+            self.tokens = min(self.tokens, available)
+        else:
+            self.tokens = min(limit, available)
+            self._synced = True
+
+    def pause(self):
+        """Stop issuing requests until the next point is refilled, after a 429."""
+        self.tokens = min(self.tokens, 0)
+        self._blocked_until = max(self._blocked_until, time.monotonic() + 1 / self.refill_per_second)
+
+    def refund(self):
+        """Give back a point that was acquired but not used."""
+        self.tokens = min(self.capacity, self.tokens + 1)
+        self.in_flight = max(0, self.in_flight - 1)
+
+class ChannelLanes:
+    """Requests of one channel waiting for a point, by lane."""
+
+    def __init__(self, join_share):
+        self.join_share = join_share
+        self.waiting = {LANE_MESSAGE: deque(), LANE_JOIN: deque()}  # Futures of waiting requests
+        self._join_credit = 0.0
+
+    def next_lane(self):
+        for waiting in self.waiting.values():
+            while waiting and waiting[0].done():
+                waiting.popleft()  # Cancelled while waiting
+        messages, joins = self.waiting[LANE_MESSAGE], self.waiting[LANE_JOIN]
+        if messages and joins:
+            self._join_credit += self.join_share
+            if self._join_credit >= 1:
+                self._join_credit -= 1
+                return LANE_JOIN
+            return LANE_MESSAGE
+        if messages:
+            return LANE_MESSAGE
+        return LANE_JOIN if joins else None
+
+class PriorityLanes:
+    """Hands out the points of a token bucket to waiting requests, message lane first.
+
+    Deleting a message or timing out a user who is chatting removes text that
+    is on screen, so these calls go ahead of the timeouts of users who only
+    joined. While both lanes are waiting, joins still get `join_share` of the
+    points, so a steady stream of chat cannot starve them.
+
+    The Helix bucket belongs to the token, not to a channel, so channels with
+    waiting requests take turns: a raid on one channel slows its own
+    enforcement down, not that of the others.
+    """
+
+    def __init__(self, bucket, join_share=JOIN_MIN_SHARE):
+        self.bucket = bucket
+        self.join_share = join_share
+        self._channels = OrderedDict()  # channel -> ChannelLanes, in turn order
+        self._joins = {}                # key -> (channel, future) of keyed requests waiting in the join lane
+        self.promoted = set()           # Keys of join requests moved to the message lane
+        self._dispatcher = None
+        self.stats = {LANE_MESSAGE: 0, LANE_JOIN: 0}
+
+    async def acquire(self, lane, channel=None, key=None):
+        """Wait until the request may be sent and take a point for it.
+
+        A request given a `key` can be moved to the message lane with promote().
+        """
+        if key is not None and key in self.promoted:
+            lane = LANE_MESSAGE
+        future = asyncio.get_running_loop().create_future()
+        lanes = self._channels.get(channel)
+        if lanes is None:
+            lanes = self._channels[channel] = ChannelLanes(self.join_share)
+        lanes.waiting[lane].append(future)
+        if key is not None and lane == LANE_JOIN:
+            self._joins[key] = (channel, future)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        started = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.bucket.refund()  # Cancelled after being handed a point
+            raise
+        finally:
+            if key is not None and self._joins.get(key, (None, None))[1] is future:
+                del self._joins[key]
+        metrics.observe(f'helix_{lane}_wait_ms', (time.perf_counter() - started) * 1000)
+
+    def promote(self, key):
+        """Move the waiting join request with this key to the message lane, along with its retries.
+
+        Returns whether a request was moved. The key is only remembered then,
+        as the request discards it when it finishes.
+        """
+        channel, future = self._joins.pop(key, (None, None))
+        lanes = self._channels.get(channel)
+        if future is None or future.done() or lanes is None:
+            return False
+        try:
+            lanes.waiting[LANE_JOIN].remove(future)
+        except ValueError:
+            return False
+        lanes.waiting[LANE_MESSAGE].append(future)
+        self.promoted.add(key)
+        return True
+
+    def _next(self):
+        """Return the lane and the future of the next request, or None when nothing waits."""
+        while self._channels:
+            channel, lanes = next(iter(self._channels.items()))
+            lane = lanes.next_lane()
+            if lane is None:
+                del self._channels[channel]
+                continue
+            self._channels.move_to_end(channel)
+            return lane, lanes.waiting[lane].popleft()
+        return None
+
+    async def _dispatch(self):
+        while self._channels:
+            await self.bucket.acquire()
+            # Chosen once the point is available, so a message that arrived meanwhile goes first
+            chosen = self._next()
+            if chosen is None:
+                self.bucket.refund()
+                return
+            lane, future = chosen
+            future.set_result(None)
+            self.stats[lane] += 1
+
+    def close(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+
+class ActionScheduler:
+    """Runs Helix moderation calls concurrently within the rate-limit budget."""
+
+    def __init__(self, twitch, base_url=HELIX_BASE_URL, concurrency=ACTION_CONCURRENCY):
+        self.twitch = twitch
+        self.base_url = base_url.rstrip('/') + '/'
+        self.bucket = TokenBucket()
+        self.lanes = PriorityLanes(self.bucket)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._session = None
+        self.stats = {'requests': 0, 'rate_limited': 0, 'retries': 0, 'errors': 0}
+        self._keyed = Counter()  # Keys of the requests in progress
+
+    async def _request(self, method, path, params, payload=None, lane=LANE_MESSAGE, key=None, channel=None):
+        """Send a Helix request in `lane` of `channel`, retrying 429s and failures; returns the JSON body, if any."""
+        if key is not None:
+            self._keyed[key] += 1
+        try:
+            return await self._send(method, path, params, payload, lane, key, channel)
+        finally:
+            if key is not None:
+                self._keyed[key] -= 1
+                if not self._keyed[key]:
+                    del self._keyed[key]
+                    self.lanes.promoted.discard(key)
+
+    async def _send(self, method, path, params, payload, lane, key, channel):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        last_error = None
+        for attempt in range(ACTION_MAX_RETRIES):
+            await self.lanes.acquire(lane, channel, key)
+            # Only requests that got their point hold a slot, so waiting joins never block messages
+            async with self._semaphore:
+                headers = {
+                    'Authorization': f"Bearer {self.twitch.get_user_auth_token()}",
+                    'Client-Id': self.twitch.app_id
+                }
+                self.stats['requests'] += 1
+                started = time.perf_counter()
+                settled = False
+                try:
+                    async with self._session.request(method, self.base_url + path, params=params,
+                                                     json=payload, headers=headers) as response:
+                        metrics.observe('helix_call_ms', (time.perf_counter() - started) * 1000)
+                        metrics.incr('helix_requests')
+                        self.bucket.settle(response.headers)
+                        settled = True
+                        if response.status == 429:
+                            self.stats['rate_limited'] += 1
+                            metrics.incr('helix_rate_limited')
+                            self.bucket.pause()
+                            last_error = HelixError(429, 'Too Many Requests')
+                        elif response.status >= 500:
+                            last_error = HelixError(response.status, await response.text())
+                        elif response.status >= 400:
+                            self.stats['errors'] += 1
+                            text = await response.text()
+                            try:
+                                message = json.loads(text).get('message', text)
+                            except (ValueError, AttributeError):
+                                message = text
+                            raise HelixError(response.status, message)
+                        elif response.content_type == 'application/json':
+                            return await response.json()
+                        else:
+                            return None
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # A slow response raises TimeoutError once the session timeout expires
+                    logger.warning(f"Helix request {method} {path} failed: {e!r}")
+                    last_error = e
+                finally:
+                    if not settled:
+                        self.bucket.settle()
+            # Jitter spreads the retries of concurrent calls after a 429 or a failure
+            await asyncio.sleep(random.uniform(0, 0.5 * (attempt + 1)))
+            self.stats['retries'] += 1
+        self.stats['errors'] += 1
+        logger.error(f"Helix request {method} {path} gave up after {ACTION_MAX_RETRIES} attempts: {last_error!r}")
+        raise last_error
+
+    async def ban(self, broadcaster_id, moderator_id, user_id, reason, duration=None, lane=LANE_MESSAGE):
+        """Ban a user, or time them out when a duration is given."""
+        data = {'user_id': user_id, 'reason': reason}
+        if duration is not None:
+            data['duration'] = duration
+        try:
+            await self._request('POST', 'moderation/bans',
+                                {'broadcaster_id': broadcaster_id, 'moderator_id': moderator_id},
+                                {'data': data}, lane, (broadcaster_id, user_id), broadcaster_id)
+        except HelixError as e:
+            # Another moderator (or an earlier redelivery) got there first
+            if e.status != 400 or 'already banned' not in e.message:
+                raise
+
+    def promote_ban(self, broadcaster_id, user_id):
+        """Send a pending ban of the user in the message lane."""
+        key = (broadcaster_id, user_id)
+        if not self.lanes.promote(key) and key in self._keyed:
+            # Being sent right now: its retries go in the message lane
+            self.lanes.promoted.add(key)
+
+    async def delete_message(self, broadcaster_id, moderator_id, message_id):
+        """Delete a single chat message."""
+        try:
+            await self._request('DELETE', 'moderation/chat', {
+                'broadcaster_id': broadcaster_id,
+                'moderator_id': moderator_id,
+                'message_id': message_id
+            }, channel=broadcaster_id)
+        except HelixError as e:
+            # Already deleted by another moderator, or cleared along with the user's timeout
+            if e.status != 404:
+                raise
+
+    async def get_users(self, logins, lane=LANE_MESSAGE, channel=None):
+        """Look up at most 100 users by login; returns the user objects Helix found."""
+        response = await self._request('GET', 'users', [('login', login) for login in logins],
+                                       lane=lane, channel=channel)
+        return response['data']
+
+    async def close(self):
+        self.lanes.close()
+        if self._session is not None:
+            await self._session.close()
+
+class UserIdResolver:
+    """Resolves logins to user ids through a bounded LRU/TTL cache and bulk get_users calls.
+
+    The calls go through the scheduler, so they share the rate-limit budget
+    and the lanes of the actions waiting for them.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self._cache = OrderedDict()  # lowercase login -> (user_id or None, expires_at as wall clock time)
+        self.stats = {'hits': 0, 'misses': 0, 'api_calls': 0}
+
+    def state(self):
+        """Cache entries as [login, user_id, expires_at], least recently used first."""
+        return [[login, user_id, expires_at] for login, (user_id, expires_at) in self._cache.items()]
+
+    def restore(self, entries):
+        now = time.time()
+        for login, user_id, expires_at in entries:
+            if expires_at > now:
+                self._cache[login] = (user_id, expires_at)
+        self._trim()
+        if self._cache:
+            logger.info(f"Restored {len(self._cache)} cached user ids.")
+
+    def _trim(self):
+        while len(self._cache) > USER_ID_CACHE_MAX_ENTRIES:
+            self._cache.popitem(last=False)
+
+    def _get_cached(self, login):
+        entry = self._cache.get(login)
+        if entry is None:
+            return _MISSING
+        if entry[1] <= time.time():
+            del self._cache[login]
+            return _MISSING
+        self._cache.move_to_end(login)
+        return entry[0]
+
+    def _store(self, login, user_id, expires_at):
+        self._cache[login] = (user_id, expires_at)
+        self._cache.move_to_end(login)
+
+    async def resolve_many(self, logins, lane=LANE_MESSAGE, channel=None):
+        """Return a login -> user_id dict, fetching uncached logins in groups of 100.
+
+        Logins that do not exist are left out; a failed lookup raises.
+        """
+        resolved = {}
+        pending = []
+        for login in dict.fromkeys(logins):
+            user_id = self._get_cached(login.lower())
+            if user_id is _MISSING:
+                pending.append(login)
+            else:
+                self.stats['hits'] += 1
+                if user_id is not None:
+                    resolved[login] = user_id
+        self.stats['misses'] += len(pending)
+
+        expires_at = time.time() + USER_ID_CACHE_TTL
+        for start in range(0, len(pending), GET_USERS_MAX_LOGINS):
+            chunk = pending[start:start + GET_USERS_MAX_LOGINS]
+            by_login = {login.lower(): login for login in chunk}
+            self.stats['api_calls'] += 1
+            started = time.perf_counter()
+            try:
+                for user_data in await self.scheduler.get_users(list(by_login), lane, channel):
+                    self._store(user_data['login'], user_data['id'], expires_at)
+                    if user_data['login'] in by_login:
+                        resolved[by_login.pop(user_data['login'])] = user_data['id']
+            except Exception as e:
+                logger.error(f"Error resolving {len(chunk)} users: {e}")
+                raise
+            finally:
+                metrics.observe('get_users_ms', (time.perf_counter() - started) * 1000)
+            for login, original in by_login.items():
+                logger.error(f"User {original} not found.")
+                self._store(login, None, time.time() + USER_NOT_FOUND_TTL)
+        self._trim()
+        return resolved
+
+    async def resolve(self, login, lane=LANE_MESSAGE, channel=None):
+        """Return the user id for a single login, or None if it does not exist."""
+        return (await self.resolve_many([login], lane, channel)).get(login)
 
 def get_ssm_parameters():
     """Fetch parameters from AWS SSM."""
@@ -40,22 +593,14 @@ async def schedule_token_refresh(user_tokens, config_collection, twitch):
     """Schedule token renewal just before it expires."""
     try:
         # Calculate the delay until the token needs to be refreshed
-        current_time = int(time.time())
-        token_age = current_time - user_tokens['obtained_at']
-        delay = max(0, user_tokens['expires_in'] - token_age - 300)  # Refresh 5 minutes early
+        delay = refresh_delay(user_tokens)
 
         logger.info(f"Scheduling token refresh in {delay} seconds...")
         await asyncio.sleep(delay)
 
         # Refresh the token
         logger.info("Refreshing access token...")
-        new_tokens = refresh_access_token(
-            user_tokens['refresh_token'],
-            user_tokens['client_id'],
-            user_tokens['client_secret']
-        )
-        update_user_tokens(config_collection, new_tokens)
-        user_tokens.update(new_tokens)
+        new_tokens = await refresh_user_tokens(user_tokens, config_collection)
         logger.info("Access token refreshed successfully.")
 
         # Update Twitch authentication
@@ -93,149 +638,382 @@ def get_twitch_credentials(config_collection):
     logger.info("Fetched Twitch credentials and bot configuration successfully.")
     return user_tokens, bot_config
 
-def update_user_tokens(config_collection, new_tokens):
-    """Update tokens in MongoDB."""
-    logger.info("Updating user tokens in MongoDB...")
-    new_tokens['expires_in'] = new_tokens.get('expires_in', 3600)
-    new_tokens['obtained_at'] = int(time.time())
+async def fetch_channel_ids(twitch, channel_names):
+    """Fetch the IDs of the given channels with a single get_users call."""
+    channel_ids = {}
     try:
-        config_collection.update_one(
-            {'_id': 'twitch_user_tokens'},
-            {'$set': new_tokens}
-        )
-        logger.info("User tokens updated successfully.")
+        async for user_info in twitch.get_users(logins=list(channel_names)):
+            logger.info(f"Found channel ID for {user_info.login}: {user_info.id}")
+            channel_ids[user_info.login] = user_info.id
     except Exception as e:
-        logger.error(f"Error updating user tokens: {e}")
-
-def refresh_token_if_needed(user_tokens, config_collection):
-    """Refresh access token if expired or near expiration."""
-    logger.info("Checking if token refresh is needed...")
-    current_time = int(time.time())
-    token_age = current_time - user_tokens['obtained_at']
-    if token_age >= user_tokens['expires_in'] - 300:  # Refresh 5 minutes before expiration
-        logger.info("Access token is near expiry. Refreshing token...")
-        try:
-            new_tokens = refresh_access_token(
-                user_tokens['refresh_token'],
-                user_tokens['client_id'],
-                user_tokens['client_secret']
-            )
-            update_user_tokens(config_collection, new_tokens)
-            return new_tokens['access_token']
-        except Exception as e:
-            logger.error(f"Error refreshing access token: {e}")
-            raise
-    else:
-        logger.info("Access token is still valid.")
-        return user_tokens['access_token']
+        logger.error(f"Error fetching channel IDs for {', '.join(channel_names)}: {e}")
+        raise
+    missing = set(channel_names) - set(channel_ids)
+    if missing:
+        logger.error(f"Channels not found: {', '.join(sorted(missing))}")
+        raise Exception(f"Channels not found: {', '.join(sorted(missing))}")
+    return channel_ids
+
+async def gather_all(*aws):
+    """Await every awaitable, then raise the first failure if any.
+
+    Unlike a plain gather, a failure does not leave the other calls of the
+    batch running unobserved.
+    """
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+async def handle_user(scheduler, channel_id, moderator_id, username, is_allowed, resolver, ledger,
+                      message_time=None, lane=LANE_MESSAGE):
+    """Handle user actions (ban/timeout) based on their status.
 
-async def fetch_channel_id(twitch, channel_name):
-    """Fetch the channel ID for the given channel name."""
+    Raises if the user could not be resolved or timed out, so the event is
+    not acknowledged and gets redelivered.
+    """
+    event_log.info("Processing user: %s with allowed status: %s", username, is_allowed,
+                   extra=logs.fields(username=username, channel_id=channel_id, allowed=is_allowed, lane=lane))
+    if is_allowed:
+        return
     try:
-        async for user_info in twitch.get_users(logins=[channel_name]):
-            if user_info:
-                logger.info(f"Found channel ID for {channel_name}: {user_info.id}")
-                return user_info.id
-        logger.error(f"Channel {channel_name} not found.")
-        raise Exception(f"Channel {channel_name} not found.")
+        if ledger.is_active(username, 'timeout', message_time):
+            ledger.stats['coalesced'] += 1
+            pending = ledger.in_flight(username, 'timeout')
+            if pending is None or lane != LANE_MESSAGE:
+                event_log.info("User %s is already timed out.", username,
+                               extra=logs.fields(username=username, channel_id=channel_id))
+                return
+            # Queued for a timeout on joining and now chatting: the timeout moves to the message lane
+            user_id = await resolver.resolve(username, lane, channel_id)
+            if user_id is not None:
+                scheduler.promote_ban(channel_id, user_id)
+            # The event is only acknowledged once the user is timed out
+            await asyncio.shield(pending)
+            return
+        user_id = await resolver.resolve(username, lane, channel_id)
+        if user_id is None:
+            return  # The account no longer exists, so there is nothing to enforce
+
+        async def timeout_user():
+            # Timeout user for 10 hours
+            await scheduler.ban(
+                broadcaster_id=channel_id,
+                moderator_id=moderator_id,
+                user_id=user_id,
+                reason="You are not allowed to chat.",
+                duration=TIMEOUT_DURATION,
+                lane=lane
+            )
+
+        if await ledger.run_once(username, 'timeout', TIMEOUT_DURATION, timeout_user, message_time):
+            action_log.info("User %s timed out for 10 hours.", username,
+                            extra=logs.fields(action='timeout', username=username, user_id=user_id,
+                                              channel_id=channel_id, duration=TIMEOUT_DURATION))
     except Exception as e:
-        logger.error(f"Error fetching channel ID for {channel_name}: {e}")
+        logger.error(f"Error processing user {username}: {e}")
         raise
 
-async def handle_user(twitch, channel_id, username, is_allowed):
-    """Handle user actions (ban/timeout) based on their status."""
-    logger.info(f"Processing user: {username} with allowed status: {is_allowed}")
+
+async def delete_messages(scheduler, channel_id, moderator_id, username, bodies, ledger):
+    """Delete the pending chat messages of an unauthorized user, all in parallel."""
+    async def delete(body):
+        message_id = body['message_id']
+        sent_at = (body.get('trace') or {}).get('receive') or parse_event_time(body.get('timestamp'))
+        if sent_at is not None and ledger.covers(username, 'timeout', sent_at):
+            # Twitch clears a user's messages when timing them out
+            metrics.incr('messages_cleared_by_timeout')
+            return
+
+        async def delete_message():
+            await scheduler.delete_message(
+                broadcaster_id=channel_id,
+                moderator_id=moderator_id,
+                message_id=message_id
+            )
+
+        try:
+            if await ledger.run_once(username, f"delete:{message_id}", DELETED_MESSAGE_TTL, delete_message):
+                metrics.observe_since('message_visible_ms', body, 'receive', channel=body.get('channel'))
+                metrics.incr('messages_deleted')
+                action_log.info("Deleted message %s from %s.", message_id, username,
+                                extra=logs.fields(action='delete', username=username, message_id=message_id,
+                                                  channel_id=channel_id))
+        except Exception as e:
+            logger.error(f"Error deleting message {message_id} from {username}: {e}")
+            raise
+
+    await gather_all(*[delete(body) for body in bodies])
+
+async def connect_twitch(config_collection, channels=None):
+    """Authenticate against Twitch and look up the moderated channels; returns (twitch, moderator_id).
+
+    The moderator is the bot's own channel, whose token makes every call.
+    `channels` maps channel names to ids known from a snapshot; only unknown
+    channels are looked up, and the mapping is updated with them.
+    """
+    user_tokens, bot_config = await run_blocking(get_twitch_credentials, config_collection)
+    access_token = await refresh_token_if_needed(user_tokens, config_collection)
+
+    # Initialize Twitch API client; every call uses the user token, so no app token is fetched
+    twitch_options = {}
+    if 'HELIX_BASE_URL' in os.environ:
+        twitch_options['base_url'] = HELIX_BASE_URL
+    twitch = await Twitch(user_tokens['client_id'], user_tokens['client_secret'], authenticate_app=False,
+                          **twitch_options)
+    await twitch.set_user_authentication(
+        access_token,
+        [
+            AuthScope.MODERATOR_MANAGE_CHAT_MESSAGES,
+            AuthScope.MODERATOR_MANAGE_BANNED_USERS,
+            AuthScope.MODERATOR_READ_CHATTERS,
+            AuthScope.CHAT_EDIT,
+            AuthScope.CHAT_READ,
+            AuthScope.WHISPERS_EDIT
+        ],
+        user_tokens['refresh_token']
+    )
+    asyncio.create_task(schedule_token_refresh(user_tokens, config_collection, twitch))
+
+    # Fetch channel IDs
+    home_channel = bot_config['channel_name'].lower()
+    channels = {} if channels is None else channels
+    missing = [name for name in dict.fromkeys([home_channel] + configured_channels(bot_config))
+               if name not in channels]
+    if missing:
+        channels.update(await fetch_channel_ids(twitch, missing))
+    return twitch, channels[home_channel]
+
+async def enforce_channel(scheduler, channel_id, moderator_id, bodies, resolver, ledger):
+    """Enforce the eligibility results of one channel."""
+    message_times = [
+        parse_event_time(body.get('timestamp')) if body.get('event_type') == 'message' else None
+        for body in bodies
+    ]
+
+    # Unauthorized messages are deleted straight away: this needs no user id and does not wait for the timeout
+    offending = {}
+    for body in bodies:
+        if not body['is_allowed'] and body.get('event_type') == 'message' and body.get('message_id'):
+            offending.setdefault(body['username'], []).append(body)
+    deletions = gather_all(*[
+        delete_messages(scheduler, channel_id, moderator_id, username, user_bodies, ledger)
+        for username, user_bodies in offending.items()
+    ])
+
+    async def enforce(lane, events):
+        # Resolve every unauthorized user of the lane with as few get_users calls as possible
+        await resolver.resolve_many([
+            body['username'] for body, message_time in events
+            if not body['is_allowed'] and not ledger.is_active(body['username'], 'timeout', message_time)
+        ], lane, channel_id)
+        # Enforce the lane concurrently; the ledger collapses duplicates in flight
+        await gather_all(*[
+            handle_user(scheduler, channel_id, moderator_id, body['username'], body['is_allowed'], resolver, ledger,
+                        message_time, lane)
+            for body, message_time in events
+        ])
+
+    # Users who are chatting are resolved and timed out without waiting for the joins of the batch
+    lanes = {LANE_MESSAGE: [], LANE_JOIN: []}
+    for body, message_time in zip(bodies, message_times):
+        lanes[LANE_MESSAGE if body.get('event_type') == 'message' else LANE_JOIN].append((body, message_time))
+    await gather_all(deletions, *[enforce(lane, events) for lane, events in lanes.items() if events])
+
+async def handle_batch(transport, messages, scheduler, moderator_id, resolver, ledgers, channels):
+    """Enforce the eligibility results carried by a batch of messages, then acknowledge them.
+
+    Events are enforced in the channel they are tagged with (`channels` maps
+    names to ids, and `ledgers` ids to the ledger of each channel); untagged
+    events belong to the moderator's own channel.
+    """
+    bodies = [body for msg in messages for body in envelope.decode(msg['Body'])]
+    batch_log.info("Received %d messages with %d events.", len(messages), len(bodies),
+                   extra=logs.fields(messages=len(messages), events=len(bodies)))
+    by_channel = {}
+    for body in bodies:
+        metrics.observe_since('output_queue_dwell_ms', body, 'publish')
+        by_channel.setdefault(body.get('channel'), []).append(body)
+
+    unknown = [name for name in by_channel if name and name not in channels]
+    if unknown:
+        # A channel added to the configuration after startup: its id is its user id
+        channels.update(await resolver.resolve_many(unknown))
+    enforcements = []
+    for name, channel_bodies in by_channel.items():
+        channel_id = channels.get(name) if name else moderator_id
+        if channel_id is None:
+            logger.error(f"Dropping {len(channel_bodies)} events of unknown channel {name}.")
+            continue
+        ledger = ledgers.get(channel_id)
+        if ledger is None:
+            ledger = ledgers[channel_id] = EnforcementLedger()
+        enforcements.append(enforce_channel(scheduler, channel_id, moderator_id, channel_bodies, resolver, ledger))
+    # Channels are enforced concurrently; the scheduler shares the rate-limit budget between them
+    # A failure leaves the whole batch unacknowledged, to be redelivered
+    await gather_all(*enforcements)
+
+    acted = time.time()
+    for body in bodies:
+        metrics.stamp(body, 'action', acted)
+        metrics.observe_since('pipeline_ms', body, 'receive', 'action', channel=body.get('channel'))
+        metrics.log_trace('action_handler', body)
+    for name, count in Counter(body.get('channel') for body in bodies).items():
+        metrics.incr('events_handled', count, channel=name)
+
+    # Deleting messages from the queue after processing
     try:
-        async for user_data in twitch.get_users(logins=[username]):
-            if user_data:
-                user_id = user_data.id
-                if not is_allowed:
-                    try:
-                        # Timeout user for 10 hours
-                        await twitch.ban_user(
-                            broadcaster_id=channel_id,
-                            moderator_id=channel_id,
-                            user_id=user_id,
-                            reason="You are not allowed to chat.",
-                            duration=36000
-                        )
-                        logger.info(f"User {username} timed out for 10 hours.")
-                    except Exception as e:
-                        logger.error(f"Error timing out user {username}: {e}")
-                return
-            else:
-                logger.error(f"User {username} not found.")
+        await run_blocking(transport.delete_batch, messages)
     except Exception as e:
-        logger.error(f"Error processing user {username}: {e}")
+        logger.error(f"Error deleting messages: {e}")
 
+    for ledger in ledgers.values():
+        ledger.prune()
+
+class WorkerPool:
+    """Batch workers sharing the event loop, added or retired as the output queue grows and shrinks.
+
+    A batch of envelopes can hold thousands of events waiting on the Helix
+    rate limit, so batches still being handled get their visibility timeout
+    extended instead of being redelivered to another worker.
+    """
+
+    def __init__(self, transport, handle, autoscaler=None):
+        self.transport = transport
+        self.handle = handle  # Coroutine function handling one received batch
+        self.autoscaler = autoscaler
+        self.keeper = VisibilityKeeper(transport, VISIBILITY_TIMEOUT)
+        self._workers = []  # (task, stop event) pairs
+        self._stop = threading.Event()
+        threading.Thread(target=self.keeper.run, args=(self._stop,), name='visibility-keeper', daemon=True).start()
+
+    def size(self):
+        return len(self._workers)
+
+    def resize(self, count):
+        """Start or stop workers until exactly `count` are running."""
+        while len(self._workers) < count:
+            stop = asyncio.Event()
+            self._workers.append((asyncio.create_task(self._work(stop)), stop))
+        while len(self._workers) > count:
+            # The worker finishes its current batch before exiting
+            _, stop = self._workers.pop()
+            stop.set()
+
+    async def _work(self, stop):
+        while not stop.is_set():
+            try:
+                # Long polling returns as soon as messages are available, so no idle sleep is needed
+                messages = await run_blocking(self.transport.receive, 10, 20)
+            except Exception as e:
+                logger.error(f"Error receiving messages: {e}")
+                await asyncio.sleep(1)
+                continue
+            if not messages:
+                continue
+            if self.autoscaler is not None:
+                self.autoscaler.observe(messages)
+            try:
+                with self.keeper.hold(messages):
+                    await self.handle(messages)
+            except Exception as e:
+                # The batch is not acknowledged and will be redelivered
+                logger.error(f"Error handling batch of {len(messages)} messages: {e}")
+
+    async def autoscale(self):
+        """Resize the pool once from a sample of the output queue."""
+        try:
+            depth = await run_blocking(self.transport.approximate_depth)
+        except Exception as e:
+            logger.error(f"Error sampling output queue depth: {e}")
+            return
+        self.resize(self.autoscaler.decide(self.size(), depth))
+
+    def cancel(self):
+        for task, _ in self._workers:
+            task.cancel()
+        self._stop.set()
+
+async def consume(transport, twitch, moderator_id, snapshot=None, state=None):
+    """Receive eligibility results from the transport and enforce them.
+
+    The channel ids (`state['channels']`), the resolved user ids and the
+    enforcement ledgers are restored from `state` and saved to `snapshot`,
+    along with the rest of `state`.
+    """
+    state = state or {}
+    channels = state.setdefault('channels', {})
+    scheduler = ActionScheduler(twitch)
+    resolver = UserIdResolver(scheduler)
+    resolver.restore(state.get('user_ids', []))
+    ledgers = {}
+    saved_ledgers = dict(state.get('ledgers', {}))
+    if state.get('ledger'):
+        saved_ledgers.setdefault(moderator_id, state['ledger'])  # Snapshot from before multi-channel support
+    for channel_id, entries in saved_ledgers.items():
+        ledgers[channel_id] = EnforcementLedger()
+        ledgers[channel_id].restore(entries)
+
+    def snapshot_state():
+        saved = {key: value for key, value in state.items() if key != 'ledger'}
+        return dict(saved, user_ids=resolver.state(),
+                    ledgers={channel_id: ledger.state() for channel_id, ledger in ledgers.items()})
+
+    async def handle(messages):
+        await handle_batch(transport, messages, scheduler, moderator_id, resolver, ledgers, channels)
+
+    # Every worker shares the resolver, the ledgers and the scheduler's rate-limit budget
+    if AUTOSCALE:
+        pool = WorkerPool(transport, handle, Autoscaler('action_workers', MIN_ACTION_WORKERS, MAX_ACTION_WORKERS))
+        pool.resize(pool.autoscaler.clamp(ACTION_WORKERS))
+    else:
+        pool = WorkerPool(transport, handle)
+        pool.resize(ACTION_WORKERS)
+    logger.info(f"Started {pool.size()} workers.")
+
+    last_snapshot = time.monotonic()
+    try:
+        while True:
+            await asyncio.sleep(AUTOSCALE_INTERVAL)
+            if pool.autoscaler is not None:
+                await pool.autoscale()
+            if snapshot is not None and time.monotonic() - last_snapshot >= SNAPSHOT_INTERVAL:
+                await run_blocking(snapshot.save, snapshot_state())
+                last_snapshot = time.monotonic()
+    finally:
+        pool.cancel()
+        if snapshot is not None:
+            snapshot.save(snapshot_state())
+        await scheduler.close()
 
 async def main():
     """Main event loop."""
     logger.info("Starting action handler...")
+    metrics.serve(METRICS_PORT)
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)  # Lets consume save its snapshot
+    lag_monitor = LoopLagMonitor()
+    asyncio.create_task(lag_monitor.run())
+    snapshot = Snapshot('action_handler')
     try:
-        ssm_params = get_ssm_parameters()
-        output_queue_url = ssm_params['/patroliaaws/output_queue_url']
+        # The snapshot is read from disk while SSM is queried
+        ssm_params, state = await asyncio.gather(run_blocking(get_ssm_parameters), run_blocking(snapshot.load))
+        state = state or {}
+        output_queue_url = ssm_params.get('/patroliaaws/output_queue_url')
         mongo_connection_string = ssm_params['/patroliamongodb/connection_string']
 
         logger.info("Connecting to MongoDB...")
         mongo_client = MongoClient(mongo_connection_string)
         db = mongo_client['patrolia']
-        config_collection = db['config']
-
-        user_tokens, bot_config = get_twitch_credentials(config_collection)
-        access_token = refresh_token_if_needed(user_tokens, config_collection)
 
-        # Initialize Twitch API client
-        twitch = await Twitch(user_tokens['client_id'], user_tokens['client_secret'])
-        await twitch.set_user_authentication(
-            access_token,
-            [
-                AuthScope.MODERATOR_MANAGE_CHAT_MESSAGES,
-                AuthScope.MODERATOR_MANAGE_BANNED_USERS,
-                AuthScope.MODERATOR_READ_CHATTERS,
-                AuthScope.CHAT_EDIT,
-                AuthScope.CHAT_READ,
-                AuthScope.WHISPERS_EDIT
-            ],
-            user_tokens['refresh_token']
-        )
-        asyncio.create_task(schedule_token_refresh(user_tokens, config_collection, twitch))
-
-        # Fetch channel ID
-        channel_name = bot_config['channel_name']
-        channel_id = await fetch_channel_id(twitch, channel_name)
-
-        sqs = boto3.client('sqs', region_name='eu-west-1')
-
-        while True:
-            response = sqs.receive_message(
-                QueueUrl=output_queue_url,
-                MaxNumberOfMessages=10,
-                WaitTimeSeconds=20
-            )
-            messages = response.get('Messages', [])
-            logger.info(f"Received {len(messages)} messages from SQS.")
-            for msg in messages:
-                body = json.loads(msg['Body'])
-                username = body['username']
-                is_allowed = body['is_allowed']
-
-                try:
-                    await handle_user(twitch, channel_id, username, is_allowed)
-                except Exception as e:
-                    logger.error(f"Error processing user {username}: {e}")
-
-                # Deleting message from the queue after processing
-                try:
-                    sqs.delete_message(
-                        QueueUrl=output_queue_url,
-                        ReceiptHandle=msg['ReceiptHandle']
-                    )
-                    logger.info(f"Message for {username} deleted from SQS.")
-                except Exception as e:
-                    logger.error(f"Error deleting message from SQS for {username}: {e}")
-
-            await asyncio.sleep(1)
+        twitch, moderator_id = await connect_twitch(db['config'], state.setdefault('channels', {}))
+        # This process serves one shard of the channels
+        transport = open_shard_transport(OUTPUT_TRANSPORT, output_queue_url, SHARD_INDEX)
+        logger.info(f"Consuming from transport: {OUTPUT_TRANSPORT}, shard {SHARD_INDEX}")
+        await consume(transport, twitch, moderator_id, snapshot, state)
+    except asyncio.CancelledError:
+        logger.info("Shutdown requested, action handler stopped.")
     except Exception as e:
         logger.error(f"Error in main process: {e}")
 
@@ -0,0 +1,145 @@
+"""Local stand-in for the Helix endpoints used by the action handler.
+
+Serves /users, /moderation/bans and /moderation/chat with a configurable
+latency and a per-minute points bucket that reports Ratelimit-* headers and
+answers 429 when exhausted, like Helix does. Point the action handler at it
+with HELIX_BASE_URL=http://localhost:8080/, or run the built-in benchmark:
+
+    python fake_helix.py bench --actions 2000 --limit 800 --latency 0.05
+"""
+import argparse
+import asyncio
+import time
+import zlib
+from aiohttp import web
+
+
+class FakeHelix:
+    def __init__(self, limit=800, latency=0.05):
+        self.limit = limit
+        self.latency = latency
+        self.points = float(limit)
+        self.updated = time.time()
+        self.calls = {'users': 0, 'bans': 0, 'chat': 0, 'rate_limited': 0}
+        self.banned = set()
+        self.logins = {}     # user_id -> login, for everyone looked up
+        self.ban_times = {}  # user_id -> time.perf_counter() of the first ban
+        self.delete_times = {}  # message_id -> time.perf_counter() of the deletion
+
+    @staticmethod
+    def user_id(login):
+        return str(zlib.crc32(login.encode()))
+
+    def _take_point(self):
+        # Like Helix, the bucket refills continuously at `limit` points per minute
+        now = time.time()
+        self.points = min(self.limit, self.points + (now - self.updated) * self.limit / 60)
+        self.updated = now
+        if self.points < 1:
+            return False
+        self.points -= 1
+        return True
+
+    def _headers(self):
+        # Ratelimit-Reset is when the bucket will be full again
+        reset = self.updated + (self.limit - self.points) * 60 / self.limit
+        return {
+            'Ratelimit-Limit': str(self.limit),
+            'Ratelimit-Remaining': str(int(self.points)),
+            'Ratelimit-Reset': str(int(reset))
+        }
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        if not self._take_point():
+            self.calls['rate_limited'] += 1
+            return web.json_response({'status': 429, 'message': 'Too Many Requests'}, status=429, headers=self._headers())
+        await asyncio.sleep(self.latency)
+        response = await handler(request)
+        response.headers.update(self._headers())
+        return response
+
+    async def users(self, request):
+        self.calls['users'] += 1
+        logins = request.query.getall('login', [])
+        for login in logins:
+            self.logins[self.user_id(login)] = login
+        return web.json_response({'data': [{
+            'id': self.user_id(login),
+            'login': login,
+            'display_name': login,
+            'type': '',
+            'broadcaster_type': '',
+            'description': '',
+            'profile_image_url': '',
+            'offline_image_url': '',
+            'view_count': 0,
+            'created_at': '2020-01-01T00:00:00Z'
+        } for login in logins]})
+
+    async def bans(self, request):
+        self.calls['bans'] += 1
+        data = (await request.json())['data']
+        self.banned.add(data['user_id'])
+        self.ban_times.setdefault(data['user_id'], time.perf_counter())
+        return web.json_response({'data': [{'user_id': data['user_id']}]})
+
+    async def chat(self, request):
+        self.calls['chat'] += 1
+        self.delete_times.setdefault(request.query.get('message_id'), time.perf_counter())
+        return web.Response(status=204)
+
+    def app(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get('/users', self.users)
+        app.router.add_post('/moderation/bans', self.bans)
+        app.router.add_delete('/moderation/chat', self.chat)
+        return app
+
+
+class _StaticTwitch:
+    """Minimal stand-in for the twitchAPI client the scheduler reads credentials from."""
+    app_id = 'fake-client-id'
+
+    def get_user_auth_token(self):
+        return 'fake-token'
+
+
+async def bench(args):
+    from action_handler import ActionScheduler
+
+    fake = FakeHelix(args.limit, args.latency)
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    await web.TCPSite(runner, 'localhost', args.port).start()
+
+    scheduler = ActionScheduler(_StaticTwitch(), f'http://localhost:{args.port}/', args.concurrency)
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        scheduler.ban('1', '1', str(user), 'benchmark', 36000) for user in range(args.actions)
+    ])
+    elapsed = time.perf_counter() - started
+    print(f"{args.actions} bans in {elapsed:.2f}s ({args.actions / elapsed:.1f}/s)")
+    print(f"scheduler: {scheduler.stats}")
+    print(f"fake helix: {fake.calls}")
+    await scheduler.close()
+    await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mode', choices=['serve', 'bench'])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--limit', type=int, default=800, help='points per minute')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per request')
+    parser.add_argument('--actions', type=int, default=1000, help='bans to issue in bench mode')
+    parser.add_argument('--concurrency', type=int, default=20, help='scheduler concurrency in bench mode')
+    args = parser.parse_args()
+    if args.mode == 'serve':
+        web.run_app(FakeHelix(args.limit, args.latency).app(), port=args.port)
+    else:
+        asyncio.run(bench(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Local stand-ins for SQS, MongoDB and the twitchAPI client used by the replay benchmark.
+
+Each fake counts its calls so the benchmark can report API usage per stage,
+and can add a fixed latency per call to approximate the network round trip.
+"""
+import time
+import threading
+from collections import Counter
+from types import SimpleNamespace
+
+from common.transport import MemoryTransport, SQS_MAX_MESSAGE_BYTES
+
+
+class FakeSqs:
+    """boto3 SQS client answering from in-memory queues, one per queue URL."""
+
+    def __init__(self, latency=0.0, max_wait=1.0):
+        self.latency = latency
+        self.max_wait = max_wait  # Long polls are cut short so the benchmark can shut down quickly
+        self.calls = Counter()    # (queue url, operation) -> calls
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def _queue(self, url, operation):
+        with self._lock:
+            self.calls[url, operation] += 1
+            if url not in self._queues:
+                self._queues[url] = MemoryTransport()
+            queue = self._queues[url]
+        if self.latency:
+            time.sleep(self.latency)
+        return queue
+
+    def send_message_batch(self, QueueUrl, Entries):
+        queue = self._queue(QueueUrl, 'send_message_batch')
+        if len(Entries) > 10:
+            raise ValueError('TooManyEntriesInBatchRequest')
+        if sum(len(entry['MessageBody'].encode()) for entry in Entries) > SQS_MAX_MESSAGE_BYTES:
+            raise ValueError('BatchRequestTooLong')
+        queue.send_batch([entry['MessageBody'] for entry in Entries])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+        queue = self._queue(QueueUrl, 'receive_message')
+        messages = queue.receive(MaxNumberOfMessages, min(WaitTimeSeconds, self.max_wait))
+        return {'Messages': messages} if messages else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        queue = self._queue(QueueUrl, 'delete_message_batch')
+        queue.delete_batch([{'ReceiptHandle': entry['ReceiptHandle']} for entry in Entries])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        queue = self._queue(QueueUrl, 'change_message_visibility_batch')
+        for entry in Entries:
+            queue.change_visibility([{'ReceiptHandle': entry['ReceiptHandle']}], entry['VisibilityTimeout'])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        queue = self._queue(QueueUrl, 'get_queue_attributes')
+        return {'Attributes': {'ApproximateNumberOfMessages': str(queue.approximate_depth())}}
+
+    def depth(self, url):
+        """Messages waiting or in flight on a queue."""
+        queue = self._queues.get(url)
+        if queue is None:
+            return 0
+        with queue._condition:
+            return len(queue._ready) + len(queue._in_flight)
+
+
+class _Cursor(list):
+    def sort(self, key, direction=1):
+        return _Cursor(sorted(self, key=lambda doc: doc[key], reverse=direction < 0))
+
+
+class _ChangeStream:
+    """Change stream on which nothing ever changes."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def try_next(self):
+        time.sleep(0.2)
+        return None
+
+
+class FakeCollection:
+    """Just enough of a pymongo collection for the allowlist lookups of the services."""
+
+    def __init__(self, usernames=(), latency=0.0):
+        self.latency = latency
+        self.docs = [{'_id': index, 'username': username} for index, username in enumerate(sorted(usernames), 1)]
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _call(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def find(self, query=None, projection=None):
+        self._call('find')
+        query = query or {}
+        docs = self.docs
+        if 'username' in query:
+            wanted = set(query['username']['$in'])
+            docs = [doc for doc in docs if doc['username'] in wanted]
+        if '_id' in query:
+            docs = [doc for doc in docs if doc['_id'] > query['_id']['$gt']]
+        return _Cursor(dict(doc) for doc in docs)
+
+    def find_one(self, query):
+        self._call('find_one')
+        return next((dict(doc) for doc in self.docs if all(doc.get(k) == v for k, v in query.items())), None)
+
+    def watch(self, **kwargs):
+        self._call('watch')
+        return _ChangeStream()
+
+
+class FakeTwitch:
+    """twitchAPI client stand-in holding the credentials of calls to a fake Helix server."""
+    app_id = 'fake-client-id'
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/') + '/'
+
+    def get_user_auth_token(self):
+        return 'fake-token'
+
+    async def close(self):
+        pass
+
+
+def chat_message(username, content, message_id, channel='benchmark'):
+    """Object shaped like the twitchio message passed to Patrolia.event_message."""
+    return SimpleNamespace(
+        echo=False,
+        channel=SimpleNamespace(name=channel),
+        author=SimpleNamespace(name=username),
+        content=content,
+        tags={'id': message_id}
+    )
@@ -0,0 +1,295 @@
+"""End-to-end replay benchmark for the processing pipeline.
+
+Replays a chat trace through the real event_poller (Patrolia), the
+eligibility_processor consumers and the action_handler consumer, with SQS,
+MongoDB and Helix replaced by local stand-ins, and reports throughput,
+message-to-enforcement latency and API calls per stage.
+
+A trace is either synthetic (`normal`, `raid` or `spam`) or a recorded JSON
+lines file, one event per line:
+
+    {"t": 0.25, "type": "message", "username": "someone", "message": "hi"}
+    {"t": 0.40, "type": "join", "username": "someone_else", "allowed": true}
+
+`t` is the offset in seconds from the start of the trace; `allowed` puts the
+user on the allowlist. Examples:
+
+    python benchmark/replay_benchmark.py raid
+    python benchmark/replay_benchmark.py spam --speed 0 --sqs-latency 0.02
+    python benchmark/replay_benchmark.py --trace chat.jsonl --output result.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import logging
+import argparse
+
+# The services live in sibling directories of this file
+_here = os.path.dirname(os.path.abspath(__file__))
+for _path in ('..', '../event_poller', '../eligibility_processor', '../action_handler'):
+    sys.path.append(os.path.normpath(os.path.join(_here, _path)))
+
+logger = logging.getLogger()
+
+INPUT_QUEUE_URL = 'https://sqs.local/input'
+OUTPUT_QUEUE_URL = 'https://sqs.local/output'
+CHANNEL_ID = '1'
+
+
+def normal_trace(duration, rate, rng):
+    """Steady chat from a mostly allowlisted audience, with a trickle of newcomers."""
+    regulars = [f'regular{index}' for index in range(200)]
+    allowed = set(rng.sample(regulars, 180))
+    events = []
+    for index in range(int(duration * rate)):
+        username = rng.choice(regulars)
+        events.append({'t': index / rate, 'type': 'message', 'username': username,
+                       'message': 'hello', 'allowed': username in allowed})
+    for second in range(int(duration)):
+        events.append({'t': second + rng.random(), 'type': 'join', 'username': f'newcomer{second}'})
+    return events
+
+
+def raid_trace(duration, rate, rng):
+    """Normal chat interrupted by hundreds of unknown users joining and chatting at once."""
+    events = normal_trace(duration, rate, rng)
+    raiders = [f'raider{index}' for index in range(max(100, int(rate * 100)))]
+    for username in raiders:
+        joined = 1 + rng.random() * 2
+        events.append({'t': joined, 'type': 'join', 'username': username})
+        if rng.random() < 0.3:
+            events.append({'t': joined + rng.random() * 5, 'type': 'message', 'username': username,
+                           'message': 'raid hype'})
+    return events
+
+
+def spam_trace(duration, rate, rng):
+    """Normal chat plus a few unauthorized accounts flooding messages."""
+    events = normal_trace(duration, rate, rng)
+    for index in range(20):
+        username = f'spammer{index}'
+        t = rng.random()
+        while t < duration:
+            events.append({'t': t, 'type': 'message', 'username': username, 'message': 'buy followers'})
+            t += 0.05
+    return events
+
+
+TRACES = {'normal': normal_trace, 'raid': raid_trace, 'spam': spam_trace}
+
+
+def load_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+async def replay(args, events):
+    # Service modules read their configuration at import time
+    os.environ['HELIX_BASE_URL'] = f'http://localhost:{args.port}/'
+    os.environ.pop('SNAPSHOT_DIR', None)  # Every run starts cold
+    from aiohttp import web
+    from common.transport import SqsTransport
+    from fake_helix import FakeHelix
+    from fakes import FakeSqs, FakeCollection, FakeTwitch, chat_message
+    from common import metrics
+    import event_poller
+    import eligibility_processor
+    import action_handler
+
+    allowed = {event['username'] for event in events if event.get('allowed')}
+    unauthorized = {event['username'] for event in events if event['username'] not in allowed}
+
+    helix = FakeHelix(args.limit, args.helix_latency)
+    runner = web.AppRunner(helix.app())
+    await runner.setup()
+    await web.TCPSite(runner, 'localhost', args.port).start()
+
+    sqs = FakeSqs(args.sqs_latency)
+    poller_collection = FakeCollection(allowed, args.mongo_latency)
+    eligibility_collection = FakeCollection(allowed, args.mongo_latency)
+    input_transport = SqsTransport(sqs, INPUT_QUEUE_URL)
+    output_transport = SqsTransport(sqs, OUTPUT_QUEUE_URL)
+
+    pool, allowlist = eligibility_processor.start(input_transport, output_transport, eligibility_collection)
+    twitch = FakeTwitch(os.environ['HELIX_BASE_URL'])
+    consumer = asyncio.create_task(action_handler.consume(output_transport, twitch, CHANNEL_ID,
+                                                               state={'channels': {'benchmark': CHANNEL_ID}}))
+
+    bot = event_poller.Patrolia(
+        token='fake-token', client_id=FakeTwitch.app_id, nick='benchmark', prefix='!',
+        initial_channels=['benchmark'], transport=input_transport, allowed_users_collection=poller_collection
+    )
+    bot.publisher.start()
+    refresher = asyncio.create_task(bot.allowlist.refresh_loop())
+    while not bot.allowlist.stats['refreshes']:
+        await asyncio.sleep(0.01)
+
+    first_seen = {}  # username -> perf_counter of their first event
+    sent_messages = {}  # message id -> (perf_counter when an unauthorized user sent it, their user id)
+    rejected = 0
+    started = time.perf_counter()
+    for event in sorted(events, key=lambda event: event['t']):
+        if args.speed:
+            delay = started + event['t'] / args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        username = event['username']
+        user_id = helix.user_id(username)
+        if event['type'] == 'message' and user_id in helix.ban_times:
+            rejected += 1  # Twitch does not let timed out users chat
+            continue
+        first_seen.setdefault(username, time.perf_counter())
+        if event['type'] == 'message':
+            message_id = uuid.uuid4().hex
+            if username in unauthorized:
+                sent_messages[message_id] = (time.perf_counter(), user_id)
+            await bot.event_message(chat_message(username, event.get('message', ''), message_id))
+        else:
+            await bot.send_join(username)
+    replayed = time.perf_counter()
+
+    # Wait for every unauthorized user and message to be enforced and both queues to empty
+    deadline = replayed + args.timeout
+    expected = {helix.user_id(username) for username in unauthorized}
+    while time.perf_counter() < deadline:
+        if (not expected - set(helix.ban_times) and bot.publisher.queue.empty()
+                and not sqs.depth(INPUT_QUEUE_URL) and not sqs.depth(OUTPUT_QUEUE_URL)):
+            break
+        await asyncio.sleep(0.01)
+    finished = time.perf_counter()
+
+    latencies = [
+        (helix.ban_times[helix.user_id(username)] - seen) * 1000
+        for username, seen in first_seen.items()
+        if username in unauthorized and helix.user_id(username) in helix.ban_times
+    ]
+    # A message disappears when it is deleted or when its author is timed out, whichever comes first
+    visible = []
+    for message_id, (sent, user_id) in sent_messages.items():
+        removed = [t for t in (helix.delete_times.get(message_id), helix.ban_times.get(user_id)) if t is not None]
+        if removed:
+            visible.append((min(removed) - sent) * 1000)
+    elapsed = finished - started
+    replayed_events = len(events) - rejected  # Messages Twitch would have refused never reach the pipeline
+    result = {
+        'events': replayed_events,
+        'users': len(first_seen),
+        'unauthorized_users': len(unauthorized),
+        'enforced_users': len(latencies),
+        'replay_seconds': round(replayed - started, 3),
+        'total_seconds': round(elapsed, 3),
+        'events_per_second': round(replayed_events / elapsed, 1),
+        'unauthorized_messages': len(sent_messages),
+        'removed_messages': len(visible),
+        'deleted_messages': len(set(sent_messages) & set(helix.delete_times)),
+        'rejected_after_timeout': rejected,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'max': max(latencies, default=None),
+        },
+        'visible_ms': {
+            'p50': percentile(visible, 0.5),
+            'p99': percentile(visible, 0.99),
+            'max': max(visible, default=None),
+        },
+        'api_calls': {
+            'event_poller': {
+                'sqs': {op: n for (url, op), n in sqs.calls.items() if url == INPUT_QUEUE_URL and op == 'send_message_batch'},
+                'mongo': dict(poller_collection.calls),
+            },
+            'eligibility_processor': {
+                'sqs': {f'{"input" if url == INPUT_QUEUE_URL else "output"}.{op}': n
+                        for (url, op), n in sqs.calls.items()
+                        if (url == INPUT_QUEUE_URL) != (op == 'send_message_batch')},
+                'mongo': dict(eligibility_collection.calls),
+            },
+            'action_handler': {
+                'sqs': {op: n for (url, op), n in sqs.calls.items() if url == OUTPUT_QUEUE_URL and op != 'send_message_batch'},
+                'helix': dict(helix.calls),
+            },
+        },
+        'stages': metrics.snapshot(),
+        'publisher': dict(bot.publisher.stats),
+        'allowlist': dict(allowlist.stats),
+    }
+    for key in ('latency_ms', 'visible_ms'):
+        result[key] = {name: None if value is None else round(value, 1) for name, value in result[key].items()}
+
+    consumer.cancel()
+    refresher.cancel()
+    await asyncio.gather(consumer, refresher, return_exceptions=True)
+    await bot.publisher.close()
+    pool.drain(5)
+    allowlist.stop()
+    await twitch.close()
+    await runner.cleanup()
+    return result
+
+
+def print_report(name, result):
+    latency = result['latency_ms']
+    print(f"trace: {name}")
+    print(f"  events: {result['events']} from {result['users']} users, "
+          f"{result['enforced_users']}/{result['unauthorized_users']} unauthorized users enforced")
+    print(f"  throughput: {result['events_per_second']} events/s "
+          f"(replayed in {result['replay_seconds']}s, drained after {result['total_seconds']}s)")
+    visible = result['visible_ms']
+    print(f"  message-to-enforcement latency: p50 {latency['p50']} ms, p99 {latency['p99']} ms, max {latency['max']} ms")
+    print(f"  unauthorized messages visible for: p50 {visible['p50']} ms, p99 {visible['p99']} ms, max {visible['max']} ms "
+          f"({result['removed_messages']}/{result['unauthorized_messages']} removed, {result['deleted_messages']} by deletion)")
+    print("  API calls:")
+    for stage, services in result['api_calls'].items():
+        for service, calls in services.items():
+            print(f"    {stage} {service}: {calls}")
+    print("  stage latencies (ms, bucket upper bounds):")
+    for name, histogram in sorted(result['stages']['histograms'].items()):
+        print(f"    {name}: n={histogram['count']} mean={histogram['mean_ms']} "
+              f"p50<={histogram['p50_ms']} p99<={histogram['p99_ms']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenario', nargs='?', choices=sorted(TRACES), default='normal', help='synthetic trace to replay')
+    parser.add_argument('--trace', help='replay a recorded JSON lines trace instead')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of synthetic chat')
+    parser.add_argument('--rate', type=float, default=5, help='background messages per second in synthetic traces')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--speed', type=float, default=1, help='replay speed multiplier; 0 replays as fast as possible')
+    parser.add_argument('--sqs-latency', type=float, default=0.01, help='seconds per SQS call')
+    parser.add_argument('--mongo-latency', type=float, default=0.002, help='seconds per MongoDB call')
+    parser.add_argument('--helix-latency', type=float, default=0.05, help='seconds per Helix call')
+    parser.add_argument('--limit', type=int, default=800, help='Helix points per minute')
+    parser.add_argument('--port', type=int, default=8089, help='port of the fake Helix server')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for enforcement after the replay')
+    parser.add_argument('--output', help='also write the result as JSON to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the service logs')
+    args = parser.parse_args()
+
+    from common import logs
+    logs.setup('benchmark', logging.INFO if args.verbose else logging.WARNING)
+    if args.trace:
+        name, events = args.trace, load_trace(args.trace)
+    else:
+        name, events = args.scenario, TRACES[args.scenario](args.duration, args.rate, random.Random(args.seed))
+
+    result = asyncio.run(replay(args, events))
+    print_report(name, result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(result, trace=name), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Event loop helpers shared by the asyncio services.
+
+Blocking SQS and MongoDB calls run through `run_blocking` on a bounded
+executor (IO_WORKERS threads, plus those reserved by the services), so they
+never stall the event loop. `LoopLagMonitor` measures how late the loop
+wakes up: every sample goes to the `loop_lag_ms` histogram, and lags of at
+least LOOP_LAG_THRESHOLD seconds are logged and counted in `loop_stalls`.
+"""
+import os
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from common import metrics
+
+logger = logging.getLogger()
+
+IO_WORKERS = int(os.environ.get('IO_WORKERS', '8'))
+LOOP_LAG_INTERVAL = 0.25
+LOOP_LAG_THRESHOLD = float(os.environ.get('LOOP_LAG_THRESHOLD', '0.1'))
+
+_io_workers = IO_WORKERS
+_io_executor = None
+_io_lock = threading.Lock()
+
+
+def reserve_io_workers(count):
+    """Add executor threads for calls that hold one for long, such as long polls.
+
+    Only effective before the first blocking call, so services call it at import time.
+    """
+    global _io_workers
+    with _io_lock:
+        _io_workers += count
+
+
+def _executor():
+    global _io_executor
+    with _io_lock:
+        if _io_executor is None:
+            _io_executor = ThreadPoolExecutor(max_workers=_io_workers, thread_name_prefix='io')
+        return _io_executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call on the I/O executor and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor(), functools.partial(func, *args, **kwargs))
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up and reports stalls."""
+
+    def __init__(self):
+        self.stats = {'stalls': 0, 'max_lag_ms': 0.0, 'total_stall_ms': 0.0}
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag_ms = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL) * 1000
+            metrics.observe('loop_lag_ms', lag_ms)
+            self.stats['max_lag_ms'] = max(self.stats['max_lag_ms'], lag_ms)
+            if lag_ms >= LOOP_LAG_THRESHOLD * 1000:
+                self.stats['stalls'] += 1
+                self.stats['total_stall_ms'] += lag_ms
+                metrics.incr('loop_stalls')
+                logger.warning(f"Event loop stalled for {lag_ms:.0f} ms.")
@@ -0,0 +1,98 @@
+"""Queue-driven sizing of the consumer pools.
+
+Every AUTOSCALE_INTERVAL seconds, a controller samples the approximate number
+of messages waiting in the queue a pool consumes (ApproximateNumberOfMessages
+on SQS) and the age of the oldest message the consumers received since the
+last sample (from its SentTimestamp), and picks a pool size within the
+configured bounds:
+
+-   One worker per AUTOSCALE_MESSAGES_PER_WORKER waiting messages.
+-   At least twice the current size while messages wait longer than
+    AUTOSCALE_MAX_MESSAGE_AGE seconds, so the pool catches up on a backlog.
+
+Growing happens at once; shrinking, one worker per sample once the smaller
+size has been enough for AUTOSCALE_SCALE_DOWN_DELAY seconds, so a pool does
+not flap during bursts. Decisions are logged and exported as metrics.
+AUTOSCALE=0 keeps every pool at its initial size.
+"""
+import os
+import math
+import time
+import logging
+
+from common import metrics
+
+logger = logging.getLogger()
+
+AUTOSCALE = os.environ.get('AUTOSCALE', '1') == '1'
+AUTOSCALE_INTERVAL = float(os.environ.get('AUTOSCALE_INTERVAL', '5'))
+AUTOSCALE_MESSAGES_PER_WORKER = int(os.environ.get('AUTOSCALE_MESSAGES_PER_WORKER', '20'))
+AUTOSCALE_MAX_MESSAGE_AGE = float(os.environ.get('AUTOSCALE_MAX_MESSAGE_AGE', '2'))
+AUTOSCALE_SCALE_DOWN_DELAY = float(os.environ.get('AUTOSCALE_SCALE_DOWN_DELAY', '30'))
+
+
+def message_age(message, now=None):
+    """Seconds since the message was sent, or None if the transport did not say."""
+    sent = (message.get('Attributes') or {}).get('SentTimestamp')
+    if sent is None:
+        return None
+    return max(0.0, (now or time.time()) - int(sent) / 1000)
+
+
+class Autoscaler:
+    """Chooses the size of one worker pool from samples of its input queue."""
+
+    def __init__(self, name, min_workers, max_workers):
+        self.name = name
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.oldest_age = 0.0    # Oldest message received since the last sample, in seconds
+        self._low_since = None  # When the pool started being larger than needed
+        self.stats = {'samples': 0, 'scaled_up': 0, 'scaled_down': 0}
+
+    def clamp(self, count):
+        return min(self.max_workers, max(self.min_workers, count))
+
+    def observe(self, messages):
+        """Note the age of messages a worker just received."""
+        now = time.time()
+        for message in messages:
+            age = message_age(message, now)
+            if age is not None and age > self.oldest_age:
+                self.oldest_age = age
+
+    def decide(self, current, depth, now=None):
+        """Return the pool size for a queue of `depth` waiting messages."""
+        now = time.monotonic() if now is None else now
+        oldest_age, self.oldest_age = self.oldest_age, 0.0
+        self.stats['samples'] += 1
+        metrics.gauge(f'{self.name}_queue_depth', depth)
+        metrics.gauge(f'{self.name}_oldest_message_age_ms', oldest_age * 1000)
+
+        wanted = math.ceil(depth / AUTOSCALE_MESSAGES_PER_WORKER)
+        if oldest_age > AUTOSCALE_MAX_MESSAGE_AGE:
+            wanted = max(wanted, current * 2)
+        wanted = self.clamp(wanted)
+
+        if wanted > current:
+            self._low_since = None
+            self.stats['scaled_up'] += 1
+            self._report(current, wanted, depth, oldest_age)
+        elif wanted < current:
+            if self._low_since is None:
+                self._low_since = now
+            if now - self._low_since < AUTOSCALE_SCALE_DOWN_DELAY:
+                wanted = current
+            else:
+                wanted = current - 1
+                self.stats['scaled_down'] += 1
+                self._report(current, wanted, depth, oldest_age)
+        else:
+            self._low_since = None
+        metrics.gauge(f'{self.name}_workers', wanted)
+        return wanted
+
+    def _report(self, current, wanted, depth, oldest_age):
+        metrics.incr(f'{self.name}_scaling_decisions')
+        logger.info(f"Scaling {self.name} from {current} to {wanted} workers: "
+                    f"{depth} messages waiting, oldest {oldest_age:.1f}s old.")
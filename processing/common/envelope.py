@@ -0,0 +1,72 @@
+"""Queue message format shared by the processing services.
+
+Version 1 envelopes pack many events into one queue message, column style:
+the field names are listed once and every event is an array of values.
+
+    {"v": 1, "f": ["event_type", "username", "timestamp"], "e": [["join", "a", "..."], ["join", "b", "..."]]}
+
+Decoding an envelope is a single `json.loads`, instead of one per event, and
+the repeated keys no longer count towards the SQS message size. Messages
+holding a single plain JSON event (the format before envelopes) are still
+decoded, so services can be upgraded while old messages are in the queues.
+
+QUEUE_FORMAT selects what producers write: `envelope` (default) or `json`,
+one event per message, for as long as consumers without envelope support
+are still running.
+"""
+import os
+import json
+
+from common.transport import SQS_MAX_MESSAGE_BYTES
+
+ENVELOPE_VERSION = 1
+QUEUE_FORMAT = os.environ.get('QUEUE_FORMAT', 'envelope')
+
+
+def _envelope(fields, rows):
+    return '{"v":%d,"f":%s,"e":[%s]}' % (ENVELOPE_VERSION, json.dumps(fields, separators=(',', ':')), ','.join(rows))
+
+
+def pack(events, max_bytes=SQS_MAX_MESSAGE_BYTES, fmt=None):
+    """Encode events into as few message bodies as fit in `max_bytes` each.
+
+    Returns a list of (body, events) pairs; the events of consecutive bodies
+    are consecutive slices of the input.
+    """
+    if not events:
+        return []
+    if (fmt or QUEUE_FORMAT) == 'json':
+        return [(json.dumps(event), [event]) for event in events]
+
+    fields = list(dict.fromkeys(key for event in events for key in event))
+    header_bytes = len(_envelope(fields, []).encode())
+    packed = []
+    rows, chunk, size = [], [], header_bytes
+    for event in events:
+        row = json.dumps([event.get(field) for field in fields], separators=(',', ':'))
+        row_bytes = len(row.encode()) + 1  # Plus the separating comma
+        if rows and size + row_bytes > max_bytes:
+            packed.append((_envelope(fields, rows), chunk))
+            rows, chunk, size = [], [], header_bytes
+        if header_bytes + row_bytes > max_bytes:
+            raise ValueError(f"Event of {row_bytes} bytes does not fit in a {max_bytes} byte message")
+        rows.append(row)
+        chunk.append(event)
+        size += row_bytes
+    packed.append((_envelope(fields, rows), chunk))
+    return packed
+
+
+def decode(body):
+    """Return the list of events carried by a message body, in either format."""
+    data = json.loads(body)
+    if not isinstance(data, dict) or 'v' not in data:
+        return [data]  # A single event from before envelopes
+    if data['v'] != ENVELOPE_VERSION:
+        raise ValueError(f"Unsupported envelope version: {data['v']}")
+    fields = data['f']
+    # Missing values are encoded as null; leave them out as a single-event message would
+    return [
+        {field: value for field, value in zip(fields, row) if value is not None}
+        for row in data['e']
+    ]
@@ -0,0 +1,187 @@
+"""Low-overhead structured logging shared by the processing services.
+
+Records are handed to a bounded queue and written as JSON lines by a
+background thread, so a log call on the hot path costs little more than
+building its message; when the queue is full, records are dropped and counted
+instead of blocking. The message is built from its arguments as the record is
+queued, since they may change once the call returns. Hot paths log through
+category loggers (`category()`) with %-style arguments, which are only
+formatted if the record survives, and pass their structured fields with
+`extra=fields(...)`:
+
+-   LOG_SAMPLING, e.g. `events=0.01,batches=0.1`: fraction of INFO/DEBUG records kept per category.
+-   LOG_RATE_LIMITS, e.g. `events=20,actions=50`: INFO/DEBUG records per second kept per category.
+
+Warnings and errors are never sampled or rate limited. Sending SIGUSR1 toggles
+full detail at runtime: every category logs at DEBUG with sampling and rate
+limits off. LOG_FULL_DETAIL=1 starts in that mode, and LOG_FORMAT=text
+switches back to plain text lines.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import signal
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+from common import metrics
+
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+DEFAULT_SAMPLING = 'events=1,batches=1,actions=1'
+DEFAULT_RATE_LIMITS = 'events=20,batches=20,actions=50'
+
+
+def _parse(spec):
+    """Parse 'name=value,...' into a dict of floats."""
+    values = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, value = item.partition('=')
+        values[name.strip()] = float(value)
+    return values
+
+
+SAMPLING = _parse(os.environ.get('LOG_SAMPLING', DEFAULT_SAMPLING))
+RATE_LIMITS = _parse(os.environ.get('LOG_RATE_LIMITS', DEFAULT_RATE_LIMITS))
+_full_detail = os.environ.get('LOG_FULL_DETAIL', '0') == '1'
+_categories = {}
+_listener = None
+_exception_formatter = logging.Formatter()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record; `extra=fields(...)` adds structured fields."""
+
+    converter = time.gmtime
+
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'service': self.service,
+            'category': record.name,
+            'message': record.getMessage(),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        elif record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def fields(**values):
+    """Structured fields of a record, passed as `extra=fields(username=..., channel=...)`."""
+    return {'fields': values}
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """Queue handler that never blocks and leaves the JSON encoding to the listener thread."""
+
+    def prepare(self, record):
+        # Build the message and exception text now: the arguments, fields and
+        # traceback frames may have changed by the time the listener gets the record
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        if getattr(record, 'fields', None):
+            record.fields = dict(record.fields)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.incr('log_records_dropped')
+
+
+class CategoryFilter(logging.Filter):
+    """Samples and rate limits the INFO/DEBUG records of one category.
+
+    The token bucket is not locked: under contention from several threads it
+    may let a few records too many through, which is cheaper than a lock.
+    """
+
+    def __init__(self, name, sample_rate=1.0, rate_limit=0.0):
+        super().__init__(name)
+        self.sample_rate = sample_rate
+        self.rate_limit = rate_limit
+        self.tokens = rate_limit
+        self.updated = time.monotonic()
+
+    def filter(self, record):
+        if _full_detail or record.levelno >= logging.WARNING:
+            return True
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            metrics.incr('log_records_sampled_out')
+            return False
+        if self.rate_limit:
+            now = time.monotonic()
+            self.tokens = min(self.rate_limit, self.tokens + (now - self.updated) * self.rate_limit)
+            self.updated = now
+            if self.tokens < 1:
+                metrics.incr('log_records_rate_limited')
+                return False
+            self.tokens -= 1
+        return True
+
+
+def category(name):
+    """Logger for a hot-path category, with its sampling and rate limit applied."""
+    logger = _categories.get(name)
+    if logger is None:
+        logger = logging.getLogger(name)
+        logger.addFilter(CategoryFilter(name, SAMPLING.get(name, 1.0), RATE_LIMITS.get(name, 0.0)))
+        if _full_detail:
+            logger.setLevel(logging.DEBUG)
+        _categories[name] = logger
+    return logger
+
+
+def set_full_detail(enabled):
+    """Switch every category between full detail (DEBUG, unsampled) and its configured limits."""
+    global _full_detail
+    _full_detail = enabled
+    for logger in _categories.values():
+        logger.setLevel(logging.DEBUG if enabled else logging.NOTSET)
+    logging.getLogger().warning(f"Full detail logging {'enabled' if enabled else 'disabled'}.")
+
+
+def _toggle_full_detail(signum, frame):
+    set_full_detail(not _full_detail)
+
+
+def setup(service, level=logging.INFO):
+    """Route the root logger through the background queue; does nothing if logging is already configured."""
+    global _listener
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    stream = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == 'text':
+        stream.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    else:
+        stream.setFormatter(JsonFormatter(service))
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    root.addHandler(_DroppingQueueHandler(log_queue))
+    root.setLevel(level)
+    _listener = QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)  # Flush what is still queued
+    try:
+        signal.signal(signal.SIGUSR1, _toggle_full_detail)
+    except (ValueError, AttributeError):
+        pass  # Not the main thread, or no SIGUSR1 on this platform
@@ -0,0 +1,232 @@
+"""Per-event tracing and process-wide latency metrics.
+
+Every event gets a trace id and a `trace` dict of high-resolution wall clock
+timestamps, one per pipeline stage it has passed:
+
+-   `receive`: event_poller saw the chat message or join.
+-   `enqueue`: event_poller handed it to the input transport.
+-   `dequeue`: eligibility_processor received it.
+-   `lookup`: its allowlist lookup finished.
+-   `publish`: eligibility_processor handed the result to the output transport.
+-   `action`: action_handler finished enforcing it.
+
+Each service turns the stages it sees into histograms and counters, served in
+the Prometheus text format on http://<METRICS_HOST>:<METRICS_PORT>/metrics.
+A sampled fraction of events (TRACE_SAMPLE_RATE, chosen from the trace id so
+that every service picks the same events) is also logged stage by stage.
+"""
+import os
+import time
+import uuid
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+
+logger = logging.getLogger()
+
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+STAGES = ('receive', 'enqueue', 'dequeue', 'lookup', 'publish', 'action')
+
+
+class Histogram:
+    """Cumulative latency histogram with fixed millisecond buckets."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)  # The last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value_ms):
+        self.counts[bisect.bisect_left(BUCKETS_MS, value_ms)] += 1
+        self.count += 1
+        self.sum += value_ms
+
+    def quantile(self, fraction):
+        """Upper bound of the bucket holding the given quantile, or None when empty."""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS_MS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+def _labels(labels):
+    """Prometheus label set of the non-None labels, e.g. 'channel="somechannel"'."""
+    return ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()) if value is not None)
+
+
+def _series(name, labels, extra=''):
+    labels = ','.join(filter(None, (labels, extra)))
+    return f'{name}{{{labels}}}' if labels else name
+
+
+class Registry:
+    """Thread-safe set of named histograms, counters and gauges.
+
+    Every metric can be split by labels, e.g. `incr('events_handled', channel=name)`;
+    labels whose value is None are left out.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, value_ms, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value_ms)
+
+    def incr(self, name, amount=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, value, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.gauges[key] = value
+
+    def snapshot(self):
+        """Counters, gauges, and the count, mean, p50 and p99 of every histogram."""
+        with self._lock:
+            return {
+                'counters': {_series(*key): value for key, value in self.counters.items()},
+                'gauges': {_series(*key): value for key, value in self.gauges.items()},
+                'histograms': {
+                    _series(*key): {
+                        'count': histogram.count,
+                        'mean_ms': round(histogram.sum / histogram.count, 1) if histogram.count else None,
+                        'p50_ms': histogram.quantile(0.5),
+                        'p99_ms': histogram.quantile(0.99),
+                    } for key, histogram in self.histograms.items()
+                },
+            }
+
+    def render(self):
+        """Prometheus text exposition of every metric."""
+        lines = []
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        declared = set()
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                declare(f"patrolia_{name}_total", 'counter')
+                lines.append(f"{_series(f'patrolia_{name}_total', labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                declare(f"patrolia_{name}", 'gauge')
+                lines.append(f"{_series(f'patrolia_{name}', labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                declare(f"patrolia_{name}", 'histogram')
+                cumulative = 0
+                for bound, count in zip(BUCKETS_MS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    lines.append(f"{_series(f'patrolia_{name}_bucket', labels, le)} {cumulative}")
+                lines.append(f"{_series(f'patrolia_{name}_sum', labels)} {histogram.sum:.3f}")
+                lines.append(f"{_series(f'patrolia_{name}_count', labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+observe = REGISTRY.observe
+incr = REGISTRY.incr
+gauge = REGISTRY.gauge
+snapshot = REGISTRY.snapshot
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes would flood the service logs
+
+
+def serve(port, host=METRICS_HOST):
+    """Serve /metrics from a background thread; a port of 0 disables the endpoint."""
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"Could not start metrics endpoint on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+def start_trace(event):
+    """Give a new event a trace id and its `receive` timestamp."""
+    event['trace_id'] = uuid.uuid4().hex[:16]
+    event['trace'] = {'receive': time.time()}
+    return event
+
+
+def stamp(event, stage, now=None):
+    """Record when an event reached a stage; events from before tracing are left alone."""
+    trace = event.get('trace')
+    if trace is not None:
+        trace[stage] = time.time() if now is None else now
+
+
+def elapsed_ms(event, since, until=None):
+    """Milliseconds between stage `since` and stage `until` (or now), None if `since` is unknown."""
+    trace = event.get('trace') or {}
+    if since not in trace:
+        return None
+    end = trace.get(until) if until else time.time()
+    if end is None:
+        return None
+    return max(0.0, (end - trace[since]) * 1000)
+
+
+def observe_since(name, event, since, until=None, **labels):
+    value = elapsed_ms(event, since, until)
+    if value is not None:
+        observe(name, value, **labels)
+
+
+def sampled(event):
+    """Whether this event is one of the TRACE_SAMPLE_RATE fraction logged in full."""
+    trace_id = event.get('trace_id')
+    if not trace_id or TRACE_SAMPLE_RATE <= 0:
+        return False
+    return int(trace_id[:8], 16) < TRACE_SAMPLE_RATE * 0x100000000
+
+
+def log_trace(service, event):
+    """Log the stages of a sampled event as offsets from its receipt."""
+    if not sampled(event):
+        return
+    trace = event['trace']
+    start = trace.get('receive', min(trace.values()))
+    stages = ' '.join(
+        f"{stage}=+{(trace[stage] - start) * 1000:.1f}ms" for stage in STAGES if stage in trace
+    )
+    logger.info(f"Trace {event['trace_id']} [{service}] {event.get('event_type')} {event.get('username')}: {stages}")
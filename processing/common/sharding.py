@@ -0,0 +1,59 @@
+"""Channel sharding across worker processes.
+
+Events are tagged with the channel they come from. event_poller routes each
+event to one of SHARD_COUNT input queues by consistent hashing of its channel,
+and every eligibility_processor and action_handler process consumes the queues
+of one shard (SHARD_INDEX), so all the work for a channel lands on the same
+processes, and adding a shard only moves about 1/SHARD_COUNT of the channels.
+
+Shard 0 uses the configured queues; shard N appends `-N` to them: the SQS
+queue URL (`.../twitch-input-queue-2`) or the transport spec (`memory:input-2`,
+`dir:/var/spool/patrolia/input-2`).
+"""
+import os
+import bisect
+import hashlib
+
+from common.transport import open_transport
+
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '1'))
+SHARD_INDEX = int(os.environ.get('SHARD_INDEX', '0'))
+RING_REPLICAS = 100  # Points per shard on the ring; more points spread channels more evenly
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring mapping keys to shards 0..shards-1."""
+
+    def __init__(self, shards, replicas=RING_REPLICAS):
+        self.shards = shards
+        points = sorted((_hash(f'{shard}:{replica}'), shard) for shard in range(shards) for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, key):
+        if self.shards == 1:
+            return 0
+        index = bisect.bisect(self._hashes, _hash(key or '')) % len(self._hashes)
+        return self._shards[index]
+
+
+def shard_name(name, shard):
+    """Name of a shard's queue or transport, given the name for shard 0."""
+    return name if shard == 0 else f'{name}-{shard}'
+
+
+def open_shard_transport(spec, sqs_queue_url, shard):
+    """Open the transport of one shard (see open_transport)."""
+    if spec == 'sqs':
+        return open_transport(spec, shard_name(sqs_queue_url, shard) if sqs_queue_url else None)
+    return open_transport(shard_name(spec, shard))
+
+
+def configured_channels(bot_config):
+    """Channels to moderate: `bot_config['channels']`, or the bot's own channel."""
+    channels = bot_config.get('channels') or [bot_config['channel_name']]
+    return list(dict.fromkeys(channel.lower() for channel in channels))
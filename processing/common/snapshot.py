@@ -0,0 +1,65 @@
+"""Local state snapshots for warm restarts.
+
+Each service periodically saves the state it would otherwise rebuild from
+Twitch and MongoDB on startup (channel id, resolved user ids, known chatters,
+allowlist, enforcement ledger) to `<SNAPSHOT_DIR>/<service>.snapshot`, and
+restores it on boot. Snapshots are read through a read-only memory map and
+written to a temporary file that atomically replaces the previous one, so a
+crash while saving never leaves a torn snapshot behind.
+
+Snapshots are disabled when SNAPSHOT_DIR is unset, and ignored once older
+than SNAPSHOT_MAX_AGE seconds.
+"""
+import os
+import json
+import mmap
+import time
+import logging
+
+logger = logging.getLogger()
+
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR')
+SNAPSHOT_INTERVAL = int(os.environ.get('SNAPSHOT_INTERVAL', '30'))
+SNAPSHOT_MAX_AGE = int(os.environ.get('SNAPSHOT_MAX_AGE', str(6 * 3600)))
+_HEADER = b'PATROLIA-SNAPSHOT 1\n'
+
+
+class Snapshot:
+    """Snapshot file of one service."""
+
+    def __init__(self, name, directory=SNAPSHOT_DIR):
+        self.path = os.path.join(directory, f'{name}.snapshot') if directory else None
+
+    def load(self):
+        """Return the saved state, or None if there is no usable snapshot."""
+        if not self.path:
+            return None
+        try:
+            with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                if view[:len(_HEADER)] != _HEADER:
+                    raise ValueError("unknown snapshot format")
+                state = json.loads(view[len(_HEADER):])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.error(f"Ignoring unreadable snapshot {self.path}: {e}")
+            return None
+        age = time.time() - state.get('saved_at', 0)
+        if age > SNAPSHOT_MAX_AGE:
+            logger.info(f"Ignoring snapshot {self.path} saved {age:.0f}s ago.")
+            return None
+        logger.info(f"Restoring snapshot {self.path} saved {age:.0f}s ago.")
+        return state
+
+    def save(self, state):
+        """Atomically replace the snapshot with `state`, a JSON-serializable dict."""
+        if not self.path:
+            return
+        data = _HEADER + json.dumps(dict(state, saved_at=time.time()), separators=(',', ':')).encode()
+        tmp_path = f'{self.path}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Error saving snapshot {self.path}: {e}")
@@ -0,0 +1,66 @@
+"""Refreshing the bot's Twitch user token, shared by the services that log in with it.
+
+The token is stored in the `twitch_user_tokens` document of the config
+collection, along with when it was obtained and how long it lasts. Whoever
+refreshes it writes the new tokens back there.
+"""
+import time
+import logging
+from twitchAPI.oauth import refresh_access_token
+
+from common.aio import run_blocking
+
+logger = logging.getLogger()
+
+TOKEN_REFRESH_MARGIN = 300  # Refresh 5 minutes before expiration
+
+
+def refresh_delay(user_tokens):
+    """Seconds until the token should be refreshed; 0 when it already should."""
+    token_age = int(time.time()) - user_tokens['obtained_at']
+    return max(0, user_tokens['expires_in'] - token_age - TOKEN_REFRESH_MARGIN)
+
+
+async def refresh_user_tokens(user_tokens, config_collection):
+    """Refresh the user access token and store the new tokens in MongoDB."""
+    access_token, refresh_token = await refresh_access_token(
+        user_tokens['refresh_token'],
+        user_tokens['client_id'],
+        user_tokens['client_secret']
+    )
+    new_tokens = {'access_token': access_token, 'refresh_token': refresh_token}
+    await update_user_tokens(config_collection, new_tokens)
+    user_tokens.update(new_tokens)
+    return new_tokens
+
+
+async def update_user_tokens(config_collection, new_tokens):
+    """Update tokens in MongoDB."""
+    logger.info("Updating user tokens in MongoDB...")
+    new_tokens['expires_in'] = new_tokens.get('expires_in', 3600)
+    new_tokens['obtained_at'] = int(time.time())
+    try:
+        await run_blocking(
+            config_collection.update_one,
+            {'_id': 'twitch_user_tokens'},
+            {'$set': new_tokens}
+        )
+        logger.info("User tokens updated successfully.")
+    except Exception as e:
+        logger.error(f"Error updating user tokens: {e}")
+
+
+async def refresh_token_if_needed(user_tokens, config_collection):
+    """Refresh access token if expired or near expiration."""
+    logger.info("Checking if token refresh is needed...")
+    if refresh_delay(user_tokens) == 0:
+        logger.info("Access token is near expiry. Refreshing token...")
+        try:
+            new_tokens = await refresh_user_tokens(user_tokens, config_collection)
+            return new_tokens['access_token']
+        except Exception as e:
+            logger.error(f"Error refreshing access token: {e}")
+            raise
+    else:
+        logger.info("Access token is still valid.")
+        return user_tokens['access_token']
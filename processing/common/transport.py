@@ -0,0 +1,322 @@
+"""Message transports connecting the processing services.
+
+Every backend exchanges messages shaped like SQS messages (dicts with
+'MessageId', 'ReceiptHandle' and 'Body'), so the services handle them the
+same way whichever backend is configured. Received messages carry their
+'SentTimestamp' attribute (epoch milliseconds), and `approximate_depth()`
+counts the messages waiting to be received. All methods are blocking and
+thread-safe; the asyncio services call them through their I/O executor.
+
+Transports are selected with a spec string:
+
+-   `sqs`: the SQS queue whose URL is stored in SSM (default).
+-   `memory:<name>`: an in-process queue, shared by every stage of a fused process.
+-   `dir:<path>`: a spool directory on local disk, shared by processes on the same host.
+"""
+import os
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from collections import deque
+import boto3
+import logging
+
+logger = logging.getLogger()
+
+SQS_BATCH_SIZE = 10
+SQS_MAX_MESSAGE_BYTES = 262144  # 256 KB, the SQS limit for a message and for a whole send_message_batch
+DEFAULT_VISIBILITY_TIMEOUT = 30  # Matches infra/main.tf
+
+
+class SqsTransport:
+    """Transport backed by an SQS queue."""
+
+    def __init__(self, sqs, queue_url):
+        self.sqs = sqs
+        self.queue_url = queue_url
+
+    @staticmethod
+    def _chunks(bodies):
+        """Split bodies into send_message_batch calls of at most 10 messages and 256 KB."""
+        start, size = 0, 0
+        for index, body in enumerate(bodies):
+            body_bytes = len(body.encode())
+            if index > start and (index - start == SQS_BATCH_SIZE or size + body_bytes > SQS_MAX_MESSAGE_BYTES):
+                yield start, bodies[start:index]
+                start, size = index, 0
+            size += body_bytes
+        if start < len(bodies):
+            yield start, bodies[start:]
+
+    def send_batch(self, bodies):
+        """Send message bodies, returning the indexes of those that could not be sent."""
+        failed = []
+        for start, chunk in self._chunks(bodies):
+            try:
+                response = self.sqs.send_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[{'Id': str(index), 'MessageBody': body} for index, body in enumerate(chunk)]
+                )
+            except Exception as e:
+                logger.error(f"Error sending batch to SQS: {e}")
+                failed.extend(range(start, start + len(chunk)))
+                continue
+            for failure in response.get('Failed', []):
+                logger.error(f"Error sending message to SQS: {failure.get('Code')} {failure.get('Message')}")
+                failed.append(start + int(failure['Id']))
+        return failed
+
+    def receive(self, max_messages=SQS_BATCH_SIZE, wait_seconds=20):
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=max_messages,
+            WaitTimeSeconds=wait_seconds,
+            AttributeNames=['SentTimestamp']
+        )
+        return response.get('Messages', [])
+
+    def approximate_depth(self):
+        response = self.sqs.get_queue_attributes(
+            QueueUrl=self.queue_url,
+            AttributeNames=['ApproximateNumberOfMessages']
+        )
+        return int(response['Attributes']['ApproximateNumberOfMessages'])
+
+    def delete_batch(self, messages):
+        """Acknowledge messages, returning those that could not be deleted."""
+        failed = []
+        for start in range(0, len(messages), SQS_BATCH_SIZE):
+            chunk = messages[start:start + SQS_BATCH_SIZE]
+            try:
+                response = self.sqs.delete_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[{'Id': str(index), 'ReceiptHandle': msg['ReceiptHandle']} for index, msg in enumerate(chunk)]
+                )
+            except Exception as e:
+                logger.error(f"Error deleting batch from SQS: {e}")
+                failed.extend(chunk)
+                continue
+            for failure in response.get('Failed', []):
+                logger.error(f"Error deleting message from SQS: {failure.get('Code')} {failure.get('Message')}")
+                failed.append(chunk[int(failure['Id'])])
+        return failed
+
+    def change_visibility(self, messages, timeout):
+        for start in range(0, len(messages), SQS_BATCH_SIZE):
+            chunk = messages[start:start + SQS_BATCH_SIZE]
+            response = self.sqs.change_message_visibility_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {'Id': str(index), 'ReceiptHandle': msg['ReceiptHandle'], 'VisibilityTimeout': timeout}
+                    for index, msg in enumerate(chunk)
+                ]
+            )
+            for failure in response.get('Failed', []):
+                logger.error(f"Error extending visibility: {failure.get('Code')} {failure.get('Message')}")
+
+
+class MemoryTransport:
+    """In-process queue with SQS-like visibility timeouts."""
+
+    def __init__(self, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+        self.visibility_timeout = visibility_timeout
+        self._ready = deque()
+        self._in_flight = {}  # receipt handle -> (message, visibility deadline)
+        self._condition = threading.Condition()
+
+    def send_batch(self, bodies):
+        attributes = {'SentTimestamp': str(int(time.time() * 1000))}
+        with self._condition:
+            for body in bodies:
+                self._ready.append({'MessageId': uuid.uuid4().hex, 'Body': body, 'Attributes': attributes})
+            self._condition.notify_all()
+        return []
+
+    def _requeue_expired(self, now):
+        expired = [handle for handle, (_, deadline) in self._in_flight.items() if deadline <= now]
+        for handle in expired:
+            self._ready.appendleft(self._in_flight.pop(handle)[0])
+
+    def receive(self, max_messages=SQS_BATCH_SIZE, wait_seconds=20):
+        deadline = time.monotonic() + wait_seconds
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._in_flight:
+                    self._requeue_expired(now)
+                if self._ready or now >= deadline:
+                    break
+                self._condition.wait(deadline - now)
+            messages = []
+            while self._ready and len(messages) < max_messages:
+                message = dict(self._ready.popleft(), ReceiptHandle=uuid.uuid4().hex)
+                self._in_flight[message['ReceiptHandle']] = (message, now + self.visibility_timeout)
+                messages.append(message)
+            return messages
+
+    def delete_batch(self, messages):
+        with self._condition:
+            for message in messages:
+                self._in_flight.pop(message['ReceiptHandle'], None)
+        return []
+
+    def change_visibility(self, messages, timeout):
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            for message in messages:
+                if message['ReceiptHandle'] in self._in_flight:
+                    self._in_flight[message['ReceiptHandle']] = (message, deadline)
+
+    def approximate_depth(self):
+        with self._condition:
+            return len(self._ready)
+
+
+class DirectoryTransport:
+    """Spool directory on local disk; a message is claimed by renaming its file, which is atomic."""
+
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, path, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+        self.visibility_timeout = visibility_timeout
+        self.ready_dir = os.path.join(path, 'ready')
+        self.in_flight_dir = os.path.join(path, 'inflight')
+        os.makedirs(self.ready_dir, exist_ok=True)
+        os.makedirs(self.in_flight_dir, exist_ok=True)
+
+    def send_batch(self, bodies):
+        failed = []
+        for index, body in enumerate(bodies):
+            # Names sort in send order; the file only appears in ready/ once fully written
+            name = f"{time.time_ns():020d}-{uuid.uuid4().hex}.json"
+            tmp_path = os.path.join(self.in_flight_dir, f".{name}.tmp")
+            try:
+                with open(tmp_path, 'w') as f:
+                    f.write(body)
+                os.replace(tmp_path, os.path.join(self.ready_dir, name))
+            except OSError as e:
+                logger.error(f"Error writing message to {self.ready_dir}: {e}")
+                failed.append(index)
+        return failed
+
+    def _requeue_expired(self):
+        cutoff = time.time()
+        for name in os.listdir(self.in_flight_dir):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.in_flight_dir, name)
+            try:
+                # The in-flight file's mtime is its visibility deadline
+                if os.stat(path).st_mtime <= cutoff:
+                    os.replace(path, os.path.join(self.ready_dir, name))
+            except FileNotFoundError:
+                pass  # Acknowledged or requeued by another consumer
+
+    def receive(self, max_messages=SQS_BATCH_SIZE, wait_seconds=20):
+        deadline = time.monotonic() + wait_seconds
+        while True:
+            self._requeue_expired()
+            messages = []
+            for name in sorted(os.listdir(self.ready_dir)):
+                if len(messages) >= max_messages:
+                    break
+                ready_path = os.path.join(self.ready_dir, name)
+                in_flight_path = os.path.join(self.in_flight_dir, name)
+                expires = time.time() + self.visibility_timeout
+                try:
+                    # The deadline is set before the rename, so the file never sits in inflight/ looking expired
+                    os.utime(ready_path, (expires, expires))
+                    os.replace(ready_path, in_flight_path)
+                    with open(in_flight_path) as f:
+                        body = f.read()
+                except FileNotFoundError:
+                    continue  # Claimed by another consumer
+                messages.append({
+                    'MessageId': name,
+                    'ReceiptHandle': name,
+                    'Body': body,
+                    'Attributes': {'SentTimestamp': str(int(name.split('-', 1)[0]) // 1000000)}
+                })
+            if messages or time.monotonic() >= deadline:
+                return messages
+            time.sleep(self.POLL_INTERVAL)
+
+    def delete_batch(self, messages):
+        for message in messages:
+            try:
+                os.remove(os.path.join(self.in_flight_dir, message['ReceiptHandle']))
+            except FileNotFoundError:
+                pass
+        return []
+
+    def change_visibility(self, messages, timeout):
+        expires = time.time() + timeout
+        for message in messages:
+            try:
+                os.utime(os.path.join(self.in_flight_dir, message['ReceiptHandle']), (expires, expires))
+            except FileNotFoundError:
+                pass
+
+    def approximate_depth(self):
+        return sum(not name.startswith('.') for name in os.listdir(self.ready_dir))
+
+
+class VisibilityKeeper:
+    """Extends the visibility timeout of batches that are taking too long to process.
+
+    `run()` is meant for a thread of its own; batches are held from any thread.
+    """
+
+    def __init__(self, transport, timeout=DEFAULT_VISIBILITY_TIMEOUT):
+        self.transport = transport
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._batches = {}  # id(messages) -> (messages, last extension time)
+
+    @contextmanager
+    def hold(self, messages):
+        key = id(messages)
+        with self._lock:
+            self._batches[key] = (messages, time.monotonic())
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._batches.pop(key, None)
+
+    def run(self, stop):
+        """Extend every held batch once half of its visibility timeout has elapsed."""
+        while not stop.wait(1):
+            now = time.monotonic()
+            with self._lock:
+                due = [(key, messages) for key, (messages, extended) in self._batches.items()
+                       if now - extended >= self.timeout / 2]
+                for key, messages in due:
+                    self._batches[key] = (messages, now)
+            for key, messages in due:
+                try:
+                    self.transport.change_visibility(messages, self.timeout)
+                    logger.warning(f"Extended visibility of a slow batch of {len(messages)} messages.")
+                except Exception as e:
+                    logger.error(f"Error extending visibility: {e}")
+
+
+_memory_transports = {}
+_memory_lock = threading.Lock()
+
+
+def open_transport(spec, sqs_queue_url=None):
+    """Create the transport described by `spec` ('sqs', 'memory:<name>' or 'dir:<path>')."""
+    if spec == 'sqs':
+        if not sqs_queue_url:
+            raise ValueError("The sqs transport needs a queue URL.")
+        return SqsTransport(boto3.client('sqs', region_name='eu-west-1'), sqs_queue_url)
+    kind, _, target = spec.partition(':')
+    if kind == 'memory' and target:
+        # Named so that every stage of a fused process gets the same queue
+        with _memory_lock:
+            return _memory_transports.setdefault(target, MemoryTransport())
+    if kind == 'dir' and target:
+        return DirectoryTransport(target)
+    raise ValueError(f"Unknown transport: {spec}")
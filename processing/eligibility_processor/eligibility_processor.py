@@ -1,15 +1,276 @@
 import os
 import boto3
-import json
+import time
+import signal
+import threading
+from collections import Counter, OrderedDict
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from common import metrics, logs, envelope
+from common.snapshot import Snapshot, SNAPSHOT_INTERVAL
+from common.autoscale import Autoscaler, AUTOSCALE, AUTOSCALE_INTERVAL
+from common.sharding import SHARD_INDEX, open_shard_transport
+from common.transport import VisibilityKeeper
 import logging
 
 # Set up logging configuration
-logging.basicConfig(
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.INFO  # You can change this to DEBUG, ERROR, etc.
-)
+logs.setup('eligibility_processor')
 logger = logging.getLogger()
+event_log = logs.category('events')
+batch_log = logs.category('batches')
+
+# Allowlist cache tuning
+NEGATIVE_CACHE_TTL = int(os.environ.get('ALLOWLIST_NEGATIVE_TTL', '30'))
+NEGATIVE_CACHE_MAX_ENTRIES = int(os.environ.get('ALLOWLIST_NEGATIVE_MAX_ENTRIES', '50000'))
+RELOAD_INTERVAL = int(os.environ.get('ALLOWLIST_RELOAD_INTERVAL', '60'))
+FULL_RELOAD_EVERY = int(os.environ.get('ALLOWLIST_FULL_RELOAD_EVERY', '10'))
+STATS_INTERVAL = int(os.environ.get('ALLOWLIST_STATS_INTERVAL', '60'))
+
+# Evaluate received messages as a batch (one lookup, one send, one delete per receive)
+BATCH_MODE = os.environ.get('ELIGIBILITY_BATCH_MODE', '1') == '1'
+
+# Consumer pool tuning; the pool is resized between the bounds from the depth of the input queue
+CONSUMER_COUNT = int(os.environ.get('ELIGIBILITY_CONSUMERS', '4'))
+MIN_CONSUMERS = int(os.environ.get('ELIGIBILITY_MIN_CONSUMERS', '1'))
+MAX_CONSUMERS = int(os.environ.get('ELIGIBILITY_MAX_CONSUMERS', '8'))
+VISIBILITY_TIMEOUT = int(os.environ.get('INPUT_VISIBILITY_TIMEOUT', '30'))  # Matches infra/main.tf
+RECEIVE_WAIT_SECONDS = 20
+
+# Transports: 'sqs' (default), 'memory:<name>' or 'dir:<path>'
+INPUT_TRANSPORT = os.environ.get('INPUT_TRANSPORT', 'sqs')
+OUTPUT_TRANSPORT = os.environ.get('OUTPUT_TRANSPORT', 'sqs')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9102'))  # 0 disables the metrics endpoint
+
+def allowlist_key(doc):
+    """(username, channel) entry of an allowlist document; a channel of None allows every channel."""
+    username = doc.get('username')
+    if not username:
+        return None
+    return (username, doc['channel'].lower() if doc.get('channel') else None)
+
+class AllowlistCache:
+    """In-memory view of patrolia.allowed_users kept current by a change stream.
+
+    A document with a `channel` only allows the user in that channel; one
+    without allows the user everywhere.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self._lock = threading.Lock()
+        self._by_id = {}                # _id -> (username, channel)
+        self._allowed = set()           # (username, channel) entries currently allowed
+        self._negative = OrderedDict()  # username -> expiry of cached "every entry of this user is known"
+        self._last_id = None            # highest _id seen, used for delta reloads
+        self._last_sync = 0.0
+        self._live = False              # True while the change stream is healthy
+        self._stop = threading.Event()
+        self.stats = {
+            'hits': 0,
+            'negative_hits': 0,
+            'misses': 0,
+            'change_events': 0,
+            'reloads': 0,
+        }
+
+    def start(self, restored=None):
+        """Load the initial snapshot and start keeping it current.
+
+        With `restored` entries from a local snapshot, the cache serves them
+        straight away and the MongoDB snapshot is loaded in the background;
+        until then, users not in `restored` are looked up in MongoDB.
+        """
+        stream = None
+        try:
+            # Open the stream before reading the snapshot so no change is lost in between
+            stream = self.collection.watch(full_document='updateLookup', max_await_time_ms=1000)
+        except PyMongoError as e:
+            logger.warning(f"Change streams unavailable, falling back to periodic reloads: {e}")
+        if restored:
+            with self._lock:
+                # Snapshots from before per-channel allowlists hold plain usernames
+                self._allowed = {(entry, None) if isinstance(entry, str) else tuple(entry) for entry in restored}
+            logger.info(f"Allowlist restored from local snapshot: {len(self._allowed)} entries.")
+        else:
+            self.full_reload()
+        threading.Thread(target=self._sync, args=(stream, bool(restored)), name='allowlist-sync', daemon=True).start()
+
+    def _sync(self, stream, reload_first):
+        # Restored entries may be stale, so the cache only turns authoritative once a reload succeeded;
+        # until then, misses still go to MongoDB
+        delay = 1
+        while reload_first:
+            try:
+                self.full_reload()
+                break
+            except PyMongoError as e:
+                logger.error(f"Error loading allowlist, retrying in {delay}s: {e}")
+            if self._stop.wait(delay):
+                if stream is not None:
+                    stream.close()
+                return
+            delay = min(delay * 2, RELOAD_INTERVAL)
+        if stream is not None:
+            self._live = True
+            self._watch(stream)
+        else:
+            self._poll()
+
+    def stop(self):
+        self._stop.set()
+
+    def full_reload(self):
+        """Replace the cached allowlist with a fresh snapshot."""
+        by_id = {}
+        last_id = None
+        for doc in self.collection.find({}, {'username': 1, 'channel': 1}):
+            by_id[doc['_id']] = allowlist_key(doc)
+            if last_id is None or doc['_id'] > last_id:
+                last_id = doc['_id']
+        with self._lock:
+            self._by_id = by_id
+            self._allowed = {key for key in by_id.values() if key}
+            self._negative.clear()
+            self._last_id = last_id
+            self._last_sync = time.monotonic()
+        self.stats['reloads'] += 1
+        logger.info(f"Allowlist snapshot loaded: {len(self._allowed)} entries.")
+
+    def delta_reload(self):
+        """Pick up documents inserted since the last reload."""
+        query = {} if self._last_id is None else {'_id': {'$gt': self._last_id}}
+        added = 0
+        for doc in self.collection.find(query, {'username': 1, 'channel': 1}).sort('_id', 1):
+            self._apply_upsert(doc)
+            self._last_id = doc['_id']
+            added += 1
+        self._last_sync = time.monotonic()
+        if added:
+            logger.info(f"Allowlist delta reload added {added} entries.")
+
+    def _apply_upsert(self, doc):
+        key = allowlist_key(doc)
+        with self._lock:
+            previous = self._by_id.get(doc['_id'])
+            if previous and previous != key:
+                self._allowed.discard(previous)
+            self._by_id[doc['_id']] = key
+            if key:
+                self._allowed.add(key)
+                self._negative.pop(key[0], None)
+
+    def _apply_delete(self, doc_id):
+        with self._lock:
+            key = self._by_id.pop(doc_id, None)
+            if key:
+                self._allowed.discard(key)
+
+    def _watch(self, stream):
+        """Apply change stream events until stopped or the stream fails."""
+        try:
+            with stream:
+                while not self._stop.is_set():
+                    change = stream.try_next()
+                    self._last_sync = time.monotonic()
+                    if change is None:
+                        continue
+                    self.stats['change_events'] += 1
+                    operation = change['operationType']
+                    if operation in ('insert', 'update', 'replace'):
+                        if change.get('fullDocument'):
+                            self._apply_upsert(change['fullDocument'])
+                        else:
+                            # Document was deleted before the update could be looked up
+                            self._apply_delete(change['documentKey']['_id'])
+                    elif operation == 'delete':
+                        self._apply_delete(change['documentKey']['_id'])
+                    elif operation in ('drop', 'rename', 'invalidate'):
+                        self.full_reload()
+                        break
+        except PyMongoError as e:
+            logger.error(f"Allowlist change stream failed, falling back to periodic reloads: {e}")
+        self._live = False
+        self._poll()
+
+    def _poll(self):
+        """Periodically refresh the allowlist when no change stream is available."""
+        cycles = 0
+        while not self._stop.wait(RELOAD_INTERVAL):
+            cycles += 1
+            try:
+                if cycles % FULL_RELOAD_EVERY == 0:
+                    self.full_reload()  # Deletions are only visible to a full reload
+                else:
+                    self.delta_reload()
+            except PyMongoError as e:
+                logger.error(f"Error reloading allowlist: {e}")
+
+    def _matches(self, username, channel):
+        return (username, None) in self._allowed or (channel is not None and (username, channel) in self._allowed)
+
+    def _lookup_cached(self, username, channel):
+        """Return True/False if the answer is known locally, None if MongoDB must be asked."""
+        if self._matches(username, channel):
+            self.stats['hits'] += 1
+            return True
+        if self._live:
+            # The change stream keeps the snapshot authoritative
+            self.stats['negative_hits'] += 1
+            return False
+        expiry = self._negative.get(username)
+        if expiry is not None and expiry > time.monotonic():
+            self.stats['negative_hits'] += 1
+            return False
+        return None
+
+    def _remember_negative(self, usernames):
+        expiry = time.monotonic() + NEGATIVE_CACHE_TTL
+        with self._lock:
+            for username in usernames:
+                self._negative[username] = expiry
+                self._negative.move_to_end(username)
+            while len(self._negative) > NEGATIVE_CACHE_MAX_ENTRIES:
+                self._negative.popitem(last=False)
+
+    def resolve_many(self, keys):
+        """Resolve several (username, channel) pairs at once, with a single $in query for the cold misses."""
+        results = {}
+        pending = []
+        for key in set(keys):
+            cached = self._lookup_cached(*key)
+            if cached is None:
+                pending.append(key)
+            else:
+                results[key] = cached
+        if pending:
+            usernames = list({username for username, _ in pending})
+            self.stats['misses'] += len(usernames)
+            started = time.perf_counter()
+            for doc in self.collection.find({'username': {'$in': usernames}}, {'username': 1, 'channel': 1}):
+                self._apply_upsert(doc)
+            metrics.observe('mongo_lookup_ms', (time.perf_counter() - started) * 1000)
+            # Every entry of these users is now cached, whichever channel they were looked up for
+            self._remember_negative(usernames)
+            results.update((key, self._matches(*key)) for key in pending)
+        return results
+
+    def is_allowed(self, username, channel=None):
+        """Return whether the user may chat in the channel, querying MongoDB only on a cold miss."""
+        return self.resolve_many([(username, channel)])[(username, channel)]
+
+    def entries(self):
+        """(username, channel) entries currently allowed, for snapshots."""
+        with self._lock:
+            return list(self._allowed)
+
+    def staleness(self):
+        """Seconds since the cache was last confirmed up to date."""
+        return time.monotonic() - self._last_sync
+
+    def log_stats(self):
+        stats = dict(self.stats, size=len(self._allowed), negative_size=len(self._negative),
+                     live=self._live, staleness=round(self.staleness(), 1))
+        logger.info(f"Allowlist cache stats: {stats}")
 
 def get_ssm_parameters():
     logger.info("Fetching SSM parameters...")
@@ -31,82 +292,283 @@ def get_ssm_parameters():
         logger.error(f"Error fetching SSM parameters: {e}")
         raise
 
+def build_result(body, is_allowed):
+    """Build the output queue payload for an input event."""
+    event_type = body.get('event_type')
+    result = {
+        'event_type': event_type,
+        'channel': body.get('channel'),
+        'username': body['username'],
+        'is_allowed': is_allowed
+    }
+
+    if event_type == 'message':
+        result.update({
+            'message': body['message'],
+            'timestamp': body['timestamp'],
+            'message_id': body.get('message_id')
+        })
+    elif event_type == 'join':
+        result.update({
+            'timestamp': body['timestamp']
+        })
+    if 'trace' in body:
+        result.update({
+            'trace_id': body.get('trace_id'),
+            'trace': body['trace']
+        })
+    return result
+
+def record_dequeue(bodies):
+    """Stamp freshly received events and measure how long they waited in the input queue."""
+    now = time.time()
+    for body in bodies:
+        metrics.stamp(body, 'dequeue', now)
+        metrics.observe_since('input_queue_dwell_ms', body, 'enqueue', 'dequeue')
+
+def record_lookup(bodies, started):
+    now = time.time()
+    metrics.observe('allowlist_lookup_ms', (time.perf_counter() - started) * 1000)
+    for body in bodies:
+        metrics.stamp(body, 'lookup', now)
+
+def count_processed(results):
+    for channel, count in Counter(result.get('channel') for result in results).items():
+        metrics.incr('events_processed', count, channel=channel)
+
+def record_publish(results):
+    """Stamp results just before they are handed to the output transport."""
+    now = time.time()
+    for result in results:
+        metrics.stamp(result, 'publish', now)
+        metrics.observe_since('eligibility_ms', result, 'dequeue', 'publish')
+        metrics.log_trace('eligibility_processor', result)
+
+def process_message(input_transport, output_transport, allowlist, msg):
+    """Evaluate, forward and acknowledge the events of a single input message."""
+    try:
+        bodies = envelope.decode(msg['Body'])
+        record_dequeue(bodies)
+
+        # Check if the users are allowed to chat
+        started = time.perf_counter()
+        results = []
+        for body in bodies:
+            username = body['username']
+            event_log.info("Processing %s event for user: %s", body.get('event_type'), username,
+                           extra=logs.fields(event_type=body.get('event_type'), username=username,
+                                             channel=body.get('channel')))
+            results.append(build_result(body, allowlist.is_allowed(username, body.get('channel'))))
+            event_log.debug("Processed %s event: %s", results[-1]['event_type'], results[-1],
+                            extra=logs.fields(event_type=results[-1]['event_type'], username=username,
+                                              allowed=results[-1]['is_allowed']))
+        record_lookup(bodies, started)
+
+        # Send results to output queue
+        record_publish(results)
+        if output_transport.send_batch([body for body, _ in envelope.pack(results)]):
+            return
+        count_processed(results)
+        event_log.info("Results sent to output queue for %d events.", len(results),
+                       extra=logs.fields(events=len(results)))
+
+        # Delete message from input queue
+        if not input_transport.delete_batch([msg]):
+            event_log.debug("Message %s deleted from input queue.", msg.get('MessageId'),
+                            extra=logs.fields(message_id=msg.get('MessageId')))
+
+    except Exception as e:
+        logger.error(f"Error processing message: {e}")
+
+def process_batch(input_transport, output_transport, allowlist, messages):
+    """Evaluate a received batch with one lookup, one send and one delete call."""
+    parsed = []
+    for msg in messages:
+        try:
+            bodies = envelope.decode(msg['Body'])
+            parsed.append((msg, bodies, [(body['username'], body.get('channel')) for body in bodies]))
+        except (ValueError, KeyError, TypeError) as e:
+            # Left on the queue, as in the per-message path
+            logger.error(f"Error parsing message {msg.get('MessageId')}: {e}")
+    if not parsed:
+        return
+    events = [body for _, bodies, _ in parsed for body in bodies]
+    record_dequeue(events)
+
+    try:
+        started = time.perf_counter()
+        allowed = allowlist.resolve_many([key for _, _, keys in parsed for key in keys])
+    except Exception as e:
+        logger.error(f"Error resolving batch of {len(parsed)} messages: {e}")
+        return
+    record_lookup(events, started)
+
+    results = []   # (input message, result) pairs
+    complete = []  # Input messages whose events all have a result
+    for msg, bodies, keys in parsed:
+        try:
+            msg_results = [build_result(body, allowed[key]) for body, key in zip(bodies, keys)]
+        except KeyError as e:
+            logger.error(f"Error processing message {msg.get('MessageId')}: missing {e}")
+            continue
+        results.extend((msg, result) for result in msg_results)
+        complete.append(msg)
+    if not complete:
+        return
+
+    record_publish([result for _, result in results])
+    packed = envelope.pack([result for _, result in results])
+    started = time.perf_counter()
+    failed = set(output_transport.send_batch([body for body, _ in packed]))
+    metrics.observe('output_send_ms', (time.perf_counter() - started) * 1000)
+
+    # Only acknowledge input messages whose results all reached the output queue
+    unsent = set()
+    forwarded = []
+    offset = 0
+    for index, (_, chunk) in enumerate(packed):
+        if index in failed:
+            unsent.update(id(msg) for msg, _ in results[offset:offset + len(chunk)])
+        else:
+            forwarded.extend(chunk)
+        offset += len(chunk)
+    count_processed(forwarded)
+    sent = [msg for msg in complete if id(msg) not in unsent]
+    if not sent:
+        return
+    input_transport.delete_batch(sent)
+    batch_log.info("Processed batch: %d messages with %d events received, %d messages forwarded, %d distinct lookups.",
+                   len(messages), len(events), len(sent), len(allowed),
+                   extra=logs.fields(messages=len(messages), events=len(events), forwarded=len(sent),
+                                     lookups=len(allowed)))
+
+class ConsumerPool:
+    """Pool of consumer threads sharing the transports and allowlist cache."""
+
+    def __init__(self, input_transport, output_transport, allowlist):
+        self.input_transport = input_transport
+        self.output_transport = output_transport
+        self.allowlist = allowlist
+        self.keeper = VisibilityKeeper(input_transport, VISIBILITY_TIMEOUT)
+        self.autoscaler = None
+        self._stop = threading.Event()
+        self._consumers = []  # (thread, stop event) pairs
+        self._retiring = []   # Threads of stopped consumers, possibly still finishing a batch
+        threading.Thread(target=self.keeper.run, args=(self._stop,), name='visibility-keeper', daemon=True).start()
+
+    def size(self):
+        return len(self._consumers)
+
+    def resize(self, count):
+        """Start or stop consumers until exactly `count` are running."""
+        while len(self._consumers) < count and not self._stop.is_set():
+            stop = threading.Event()
+            thread = threading.Thread(target=self._consume, args=(stop,),
+                                      name=f'consumer-{len(self._consumers)}', daemon=True)
+            self._consumers.append((thread, stop))
+            thread.start()
+        while len(self._consumers) > count:
+            # The consumer finishes its current batch before exiting
+            thread, stop = self._consumers.pop()
+            stop.set()
+            self._retiring = [retiring for retiring in self._retiring if retiring.is_alive()] + [thread]
+
+    def _consume(self, stop):
+        """Receive, process and acknowledge batches until asked to stop."""
+        while not stop.is_set() and not self._stop.is_set():
+            try:
+                messages = self.input_transport.receive(10, RECEIVE_WAIT_SECONDS)
+            except Exception as e:
+                logger.error(f"Error receiving messages: {e}")
+                stop.wait(1)
+                continue
+
+            if not messages:
+                continue
+            if self.autoscaler is not None:
+                self.autoscaler.observe(messages)
+            batch_log.info("Received %d messages.", len(messages), extra=logs.fields(messages=len(messages)))
+            with self.keeper.hold(messages):
+                if BATCH_MODE:
+                    process_batch(self.input_transport, self.output_transport, self.allowlist, messages)
+                else:
+                    for msg in messages:
+                        process_message(self.input_transport, self.output_transport, self.allowlist, msg)
+
+    def autoscale(self, autoscaler):
+        """Resize the pool from samples of the input queue until the pool is drained."""
+        self.autoscaler = autoscaler
+        while not self._stop.wait(AUTOSCALE_INTERVAL):
+            try:
+                depth = self.input_transport.approximate_depth()
+            except Exception as e:
+                logger.error(f"Error sampling input queue depth: {e}")
+                continue
+            self.resize(autoscaler.decide(self.size(), depth))
+
+    def drain(self, timeout):
+        """Stop receiving and wait for in-flight batches to finish."""
+        self._stop.set()
+        threads = [thread for thread, _ in self._consumers] + self._retiring
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        unfinished = sum(thread.is_alive() for thread in threads)
+        if unfinished:
+            logger.warning(f"{unfinished} consumers still busy after drain timeout; their messages will be redelivered.")
+
+def start(input_transport, output_transport, allowed_users_collection, state=None):
+    """Start the allowlist cache and the consumer pool; returns both so the caller can stop them."""
+    allowlist = AllowlistCache(allowed_users_collection)
+    allowlist.start((state or {}).get('allowlist'))
+    pool = ConsumerPool(input_transport, output_transport, allowlist)
+    if AUTOSCALE:
+        autoscaler = Autoscaler('eligibility_consumers', MIN_CONSUMERS, MAX_CONSUMERS)
+        pool.resize(autoscaler.clamp(CONSUMER_COUNT))
+        threading.Thread(target=pool.autoscale, args=(autoscaler,), name='autoscaler', daemon=True).start()
+    else:
+        pool.resize(CONSUMER_COUNT)
+    logger.info(f"Started {pool.size()} consumers.")
+    return pool, allowlist
+
 def main():
+    metrics.serve(METRICS_PORT)
+    snapshot = Snapshot('eligibility_processor')
     try:
         # Fetch parameters from SSM
         ssm_params = get_ssm_parameters()
-        input_queue_url = ssm_params['/patroliaaws/input_queue_url']
-        output_queue_url = ssm_params['/patroliaaws/output_queue_url']
+        input_queue_url = ssm_params.get('/patroliaaws/input_queue_url')
+        output_queue_url = ssm_params.get('/patroliaaws/output_queue_url')
         mongo_connection_string = ssm_params['/patroliamongodb/connection_string']
 
         logger.info("Connecting to MongoDB...")
         # Connect to MongoDB
         mongo_client = MongoClient(mongo_connection_string)
         db = mongo_client['patrolia']
-        allowed_users_collection = db['allowed_users']
-
-        # Initialize the SQS client
-        sqs = boto3.client('sqs', region_name='eu-west-1')
-        logger.info(f"Connected to SQS. Input Queue URL: {input_queue_url}, Output Queue URL: {output_queue_url}")
-
-        while True:
-            logger.info("Polling messages from input queue...")
-            # Receive messages from SQS
-            response = sqs.receive_message(
-                QueueUrl=input_queue_url,
-                MaxNumberOfMessages=10,
-                WaitTimeSeconds=20
-            )
-
-            messages = response.get('Messages', [])
-            logger.info(f"Received {len(messages)} messages.")
-            for msg in messages:
-                try:
-                    body = json.loads(msg['Body'])
-                    event_type = body.get('event_type')
-                    username = body['username']
-                    logger.info(f"Processing {event_type} event for user: {username}")
-
-                    # Check if the user is allowed to chat
-                    user_record = allowed_users_collection.find_one({'username': username})
-                    is_allowed = user_record is not None
-
-                    result = {
-                        'event_type': event_type,
-                        'username': username,
-                        'is_allowed': is_allowed
-                    }
-
-                    if event_type == 'message':
-                        result.update({
-                            'message': body['message'],
-                            'timestamp': body['timestamp'],
-                            'message_id': body.get('message_id')
-                        })
-                        logger.info(f"Processed message event: {result}")
-                    elif event_type == 'join':
-                        result.update({
-                            'timestamp': body['timestamp']
-                        })
-                        logger.info(f"Processed join event: {result}")
-
-                    # Send result to output queue
-                    sqs.send_message(
-                        QueueUrl=output_queue_url,
-                        MessageBody=json.dumps(result)
-                    )
-                    logger.info(f"Result sent to output queue for {username}.")
-
-                    # Delete message from input queue
-                    sqs.delete_message(
-                        QueueUrl=input_queue_url,
-                        ReceiptHandle=msg['ReceiptHandle']
-                    )
-                    logger.info(f"Message for {username} deleted from input queue.")
-
-                except Exception as e:
-                    logger.error(f"Error processing message: {e}")
-                    continue
+
+        # Transports are thread-safe and shared by every consumer; this process serves one shard of the channels
+        input_transport = open_shard_transport(INPUT_TRANSPORT, input_queue_url, SHARD_INDEX)
+        output_transport = open_shard_transport(OUTPUT_TRANSPORT, output_queue_url, SHARD_INDEX)
+        logger.info(f"Input transport: {INPUT_TRANSPORT}, output transport: {OUTPUT_TRANSPORT}, shard {SHARD_INDEX}")
+
+        shutdown = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: shutdown.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: shutdown.set())
+
+        pool, allowlist = start(input_transport, output_transport, db['allowed_users'], snapshot.load())
+
+        last_stats = time.monotonic()
+        while not shutdown.wait(SNAPSHOT_INTERVAL):
+            snapshot.save({'allowlist': allowlist.entries()})
+            if time.monotonic() - last_stats >= STATS_INTERVAL:
+                allowlist.log_stats()
+                last_stats = time.monotonic()
+
+        logger.info("Shutdown requested, draining consumers...")
+        pool.drain(RECEIVE_WAIT_SECONDS + VISIBILITY_TIMEOUT)
+        snapshot.save({'allowlist': allowlist.entries()})
+        allowlist.stop()
+        logger.info("Eligibility processor stopped.")
 
     except Exception as e:
         logger.error(f"Error in main process: {e}")
@@ -1,20 +1,351 @@
+import os
+import sys
+import signal
 import asyncio
+import functools
 import boto3
 import json
 import time
+from collections import Counter
 from twitchio.ext import commands
+from twitchAPI.twitch import Twitch
+from twitchAPI.type import AuthScope
+from pymongo import MongoClient
+from common import metrics, logs, envelope
+from common.aio import run_blocking, LoopLagMonitor
+from common.snapshot import Snapshot, SNAPSHOT_INTERVAL
+from common.sharding import HashRing, SHARD_COUNT, open_shard_transport, configured_channels
+from common.tokens import refresh_delay, refresh_token_if_needed
 import logging
 
 # Set up logging configuration
-logging.basicConfig(
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+logs.setup('event_poller')
 logger = logging.getLogger()
+event_log = logs.category('events')
+
+# Transport events are published to: 'sqs' (default), 'memory:<name>' or 'dir:<path>'
+INPUT_TRANSPORT = os.environ.get('INPUT_TRANSPORT', 'sqs')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9101'))  # 0 disables the metrics endpoint
+
+# Buffered event publisher
+PUBLISH_QUEUE_SIZE = int(os.environ.get('PUBLISH_QUEUE_SIZE', '5000'))
+PUBLISH_FLUSH_INTERVAL = float(os.environ.get('PUBLISH_FLUSH_INTERVAL', '0.05'))  # Max wait for a batch to fill
+PUBLISH_FLUSHERS = int(os.environ.get('PUBLISH_FLUSHERS', '4'))
+PUBLISH_OVERFLOW_POLICY = os.environ.get('PUBLISH_OVERFLOW_POLICY', 'spill')  # spill, block, drop_newest or drop_oldest
+# Only survives a restart on a volume; events left in it are replayed at startup
+PUBLISH_SPILL_PATH = os.environ.get('PUBLISH_SPILL_PATH', '/tmp/event_poller_spill.jsonl')
+PUBLISH_MAX_BLOCKED = int(os.environ.get('PUBLISH_MAX_BLOCKED', '1000'))  # Publishers waiting for room under 'block'
+PUBLISH_MAX_ATTEMPTS = 3
+PUBLISH_BATCH_SIZE = 10  # One SQS send_message_batch of single-event messages
+PUBLISH_ENVELOPE_EVENTS = int(os.environ.get('PUBLISH_ENVELOPE_EVENTS', '500'))  # Events per flush when packing envelopes
+STATS_INTERVAL = 60
+
+# The user token logs in to IRC and reads the chatters lists
+USER_SCOPES = [AuthScope.MODERATOR_READ_CHATTERS, AuthScope.CHAT_READ]
+TOKEN_RETRY_INTERVAL = 60  # Seconds between attempts while the token cannot be refreshed
+
+class EventPublisher:
+    """Buffers events in a bounded queue and publishes them to the transport in batches.
+
+    Given a list of transports, one per shard, each event goes to the shard
+    of its channel.
+    """
+
+    def __init__(self, transport, policy=PUBLISH_OVERFLOW_POLICY):
+        if policy not in ('block', 'drop_newest', 'drop_oldest', 'spill'):
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.transports = transport if isinstance(transport, list) else [transport]
+        self.ring = HashRing(len(self.transports))
+        self.policy = policy
+        self.queue = asyncio.Queue(maxsize=PUBLISH_QUEUE_SIZE)
+        self.batch_size = PUBLISH_BATCH_SIZE if envelope.QUEUE_FORMAT == 'json' else PUBLISH_ENVELOPE_EVENTS
+        self._batch_ready = asyncio.Event()
+        self._spilled = 0  # Events waiting in the spill file
+        self._blocked = 0  # Publishers waiting for room
+        self._replaying = False
+        self._replay_task = None
+        self._tasks = []
+        self.stats = {
+            'published': 0,
+            'batches': 0,
+            'failed': 0,
+            'dropped': 0,
+            'spilled': 0,
+            'flush_ms_total': 0.0,
+            'flush_ms_max': 0.0,
+            'max_depth': 0,
+        }
+
+    def start(self):
+        """Start the flusher tasks, and replay the events spilled before a restart."""
+        self._tasks = [asyncio.create_task(self._flush_loop()) for _ in range(PUBLISH_FLUSHERS)]
+        self._tasks.append(asyncio.create_task(self._report_loop()))
+        self._recover_spill()
+        if self._spilled:
+            self._replay_task = asyncio.create_task(self._replay_spill())
+
+    def _recover_spill(self):
+        """Count the events a previous run left in the spill file."""
+        replay_path = f"{PUBLISH_SPILL_PATH}.replay"
+        if os.path.exists(replay_path):
+            # Stopped during a replay: its events go back with the others
+            with open(replay_path) as src, open(PUBLISH_SPILL_PATH, 'a') as dst:
+                dst.write(src.read())
+            os.remove(replay_path)
+        try:
+            with open(PUBLISH_SPILL_PATH) as f:
+                self._spilled = sum(1 for line in f if line.strip())
+        except FileNotFoundError:
+            return
+        if self._spilled:
+            logger.info(f"Found {self._spilled} events spilled before the restart.")
+
+    async def publish(self, event):
+        """Queue an event for publishing, applying the overflow policy when the buffer is full."""
+        if self.queue.full():
+            if self.policy == 'block':
+                if self._blocked >= PUBLISH_MAX_BLOCKED:
+                    # twitchio handles every IRC event in a task of its own, so the waiting is bounded too
+                    self.stats['dropped'] += 1
+                    return
+                self._blocked += 1
+                try:
+                    await self.queue.put(event)  # Backpressure: the caller waits for room
+                finally:
+                    self._blocked -= 1
+            elif self.policy == 'drop_newest':
+                self.stats['dropped'] += 1
+                return
+            elif self.policy == 'drop_oldest':
+                self.queue.get_nowait()
+                self.stats['dropped'] += 1
+                self.queue.put_nowait(event)
+            else:
+                self._spill(event)
+                return
+        else:
+            self.queue.put_nowait(event)
+        depth = self.queue.qsize()
+        self.stats['max_depth'] = max(self.stats['max_depth'], depth)
+        if depth >= self.batch_size:
+            self._batch_ready.set()
+
+    def _spill(self, event):
+        with open(PUBLISH_SPILL_PATH, 'a') as f:
+            f.write(json.dumps(event) + '\n')
+        self._spilled += 1
+        self.stats['spilled'] += 1
+
+    async def _replay_spill(self):
+        """Move spilled events back into the buffer once it has drained."""
+        replay_path = f"{PUBLISH_SPILL_PATH}.replay"
+        self._replaying = True
+        try:
+            os.replace(PUBLISH_SPILL_PATH, replay_path)
+            self._spilled = 0
+            events = []
+            with open(replay_path) as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        if line.strip():
+                            logger.warning("Skipping a spilled event cut short by a crash.")
+            os.remove(replay_path)
+            logger.info(f"Replaying {len(events)} spilled events.")
+            for event in events:
+                # Wait for room rather than spilling the same events again
+                await self.queue.put(event)
+                if self.queue.qsize() >= self.batch_size:
+                    self._batch_ready.set()
+        except FileNotFoundError:
+            self._spilled = 0
+        finally:
+            self._replaying = False
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        if self.queue.qsize() < self.batch_size - 1:
+            # Give the batch a short time to fill before flushing it
+            self._batch_ready.clear()
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), PUBLISH_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        while len(batch) < self.batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def _flush_loop(self):
+        while True:
+            batch = await self._next_batch()
+            await self._send(batch)
+            if self._spilled and not self._replaying and self.queue.qsize() < PUBLISH_QUEUE_SIZE // 2:
+                self._replay_task = asyncio.create_task(self._replay_spill())
+
+    async def _send(self, batch):
+        if len(self.transports) == 1:
+            await self._send_shard(self.transports[0], batch)
+            return
+        shards = {}
+        for event in batch:
+            shards.setdefault(self.ring.shard_for(event.get('channel')), []).append(event)
+        await asyncio.gather(*[self._send_shard(self.transports[shard], events) for shard, events in shards.items()])
+
+    async def _send_shard(self, transport, batch):
+        for attempt in range(1, PUBLISH_MAX_ATTEMPTS + 1):
+            started = time.perf_counter()
+            enqueued = time.time()
+            for event in batch:
+                metrics.stamp(event, 'enqueue', enqueued)
+            try:
+                packed = envelope.pack(batch)
+                failed = await run_blocking(transport.send_batch, [body for body, _ in packed])
+            except Exception as e:
+                logger.error(f"Error publishing batch of {len(batch)} messages (attempt {attempt}): {e}")
+                await asyncio.sleep(0.5 * attempt)
+                continue
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.stats['batches'] += 1
+            self.stats['flush_ms_total'] += elapsed_ms
+            self.stats['flush_ms_max'] = max(self.stats['flush_ms_max'], elapsed_ms)
+            unsent = [event for index in failed for event in packed[index][1]]
+            self.stats['published'] += len(batch) - len(unsent)
+            metrics.observe('input_send_ms', elapsed_ms)
+            metrics.incr('input_messages_sent', len(packed) - len(failed))
+            published = Counter()
+            for index, (_, events) in enumerate(packed):
+                if index not in failed:
+                    for event in events:
+                        published[event.get('channel')] += 1
+                        metrics.observe_since('publish_buffer_ms', event, 'receive', 'enqueue')
+                        metrics.log_trace('event_poller', event)
+            for channel, count in published.items():
+                metrics.incr('events_published', count, channel=channel)
+            if not failed:
+                return
+            batch = unsent
+        self.stats['failed'] += len(batch)
+        logger.error(f"Gave up publishing {len(batch)} messages after {PUBLISH_MAX_ATTEMPTS} attempts.")
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            batches = self.stats['batches']
+            logger.info(
+                f"Publisher stats: depth={self.queue.qsize()} "
+                f"avg_fill={self.stats['published'] / batches if batches else 0:.1f} "
+                f"avg_flush_ms={self.stats['flush_ms_total'] / batches if batches else 0:.1f} {self.stats}"
+            )
+
+    async def close(self):
+        """Publish everything still buffered, then stop the flushers."""
+        while not self.queue.empty():
+            await self._send([self.queue.get_nowait() for _ in range(min(self.batch_size, self.queue.qsize()))])
+        for task in self._tasks:
+            task.cancel()
+
+# Chatters polling
+CHATTERS_PAGE_SIZE = 1000  # Helix maximum for get_chatters
+POLL_INTERVAL_MIN = int(os.environ.get('POLL_INTERVAL_MIN', '15'))
+POLL_INTERVAL_MAX = int(os.environ.get('POLL_INTERVAL_MAX', '7200'))
+POLL_BACKOFF = 1.5  # Growth of the interval per quiet poll
+
+class ChattersSync:
+    """Streams the paginated chatters list and diffs it against the known chatters page by page."""
+
+    def __init__(self):
+        self.known = set()  # Interned logins of the chatters seen in the last complete sync
+
+    async def sync(self, twitch, broadcaster_id, moderator_id, on_join):
+        """Run one sync; `on_join` is awaited for each new chatter as soon as its page arrives.
+
+        Returns the (joined, parted) counts. Parts are only known once every
+        page has been read, so they are not reported after a failed sync.
+        """
+        seen = set()
+        joined = 0
+        try:
+            response = await twitch.get_chatters(broadcaster_id, moderator_id, first=CHATTERS_PAGE_SIZE)
+            # Iterating the response fetches the following pages on demand
+            async for chatter in response:
+                login = sys.intern(chatter.user_login)
+                seen.add(login)
+                if login not in self.known:
+                    self.known.add(login)
+                    joined += 1
+                    await on_join(login)
+        except Exception:
+            self.known |= seen
+            raise
+        parted = len(self.known - seen)
+        self.known = seen
+        return joined, parted
+
+# Edge pre-filter
+ALLOWLIST_REFRESH_INTERVAL = int(os.environ.get('ALLOWLIST_REFRESH_INTERVAL', '60'))
+
+class AllowlistFilter:
+    """Periodically refreshed copy of the allowlist, used to drop events from allowed users at the edge.
+
+    Only a positive match drops an event; anyone not (yet) in the local copy
+    still goes through the pipeline, so a stale copy can at worst let a user
+    who was just removed from the allowlist chat until the next refresh.
+    A document with a `channel` only allows the user in that channel.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.allowed = frozenset()  # (username, channel) pairs; a channel of None allows every channel
+        self.stats = {'dropped': 0, 'forwarded': 0, 'refreshes': 0}
+
+    def _load(self):
+        return frozenset(
+            (doc['username'], doc['channel'].lower() if doc.get('channel') else None)
+            for doc in self.collection.find({}, {'_id': 0, 'username': 1, 'channel': 1}) if doc.get('username')
+        )
+
+    async def refresh_loop(self):
+        while True:
+            try:
+                self.allowed = await run_blocking(self._load)
+                self.stats['refreshes'] += 1
+                logger.info(f"Allowlist filter refreshed: {len(self.allowed)} entries, {self.stats}")
+            except Exception as e:
+                logger.error(f"Error refreshing allowlist filter: {e}")
+            await asyncio.sleep(ALLOWLIST_REFRESH_INTERVAL)
+
+    def is_allowed(self, username, channel=None):
+        if (username, None) in self.allowed or (channel is not None and (username, channel) in self.allowed):
+            self.stats['dropped'] += 1
+            return True
+        self.stats['forwarded'] += 1
+        return False
+
+    def state(self):
+        return [list(entry) for entry in self.allowed]
+
+    def restore(self, entries):
+        # Snapshots from before per-channel allowlists hold plain usernames
+        self.allowed = frozenset((entry, None) if isinstance(entry, str) else tuple(entry) for entry in entries)
+
+class ChannelPoller:
+    """Chatters list of one channel, polled more often while the channel is active."""
+
+    def __init__(self, name):
+        self.name = name
+        self.chatters = ChattersSync()  # Track known users
+        self.activity_detected = False  # Tracks recent activity
+        self.poll_interval = POLL_INTERVAL_MAX  # Start with low frequency (2 hours)
+        self.activity = asyncio.Event()  # Wakes the chatters poller early
 
 class Patrolia(commands.Bot):
-    def __init__(self, token, client_id, nick, prefix, initial_channels, sqs_queue_url):
-        """Initialize the Patrolia bot."""
+    def __init__(self, token, client_id, nick, prefix, initial_channels, transport, allowed_users_collection=None):
+        """Initialize the Patrolia bot.
+
+        Events of untagged origin belong to the first of `initial_channels`.
+        `transport` may be a list of transports, one per shard.
+        """
         super().__init__(
             token=token,
             client_id=client_id,
@@ -22,83 +353,286 @@ class Patrolia(commands.Bot):
             prefix=prefix,
             initial_channels=initial_channels
         )
-        self.sqs = boto3.client('sqs', region_name='eu-west-1')
-        self.queue_url = sqs_queue_url
-        self.activity_detected = False  # Tracks recent activity
-        self.known_users = set()        # Track known users
-        self.poll_interval = 7200       # Start with low frequency (2 hours)
+        self.transport = transport
+        self.home_channel = initial_channels[0].lower()
+        self.pollers = {channel.lower(): ChannelPoller(channel.lower()) for channel in initial_channels}
+        self.lag_monitor = LoopLagMonitor()
+        self.publisher = EventPublisher(self.transport)
+        self.allowlist = AllowlistFilter(allowed_users_collection) if allowed_users_collection is not None else None
+        self.channels = {}  # Channel name -> id
+        self.channel_id = None  # Id of the bot's own channel, used as moderator id
+        self.snapshot = None
+        self.user_tokens = None  # Token document, kept fresh when set along with config_collection
+        self.config_collection = None
+        self._started = False
 
-    def send_to_sqs(self, message_body):
-        """Encapsulate sending messages to SQS."""
-        try:
-            self.sqs.send_message(
-                QueueUrl=self.queue_url,
-                MessageBody=json.dumps(message_body)
-            )
-            logger.info(f"Sent message to SQS: {message_body}")
-        except Exception as e:
-            logger.error(f"Error sending message to SQS: {e}")
+    async def send_event(self, message_body):
+        """Encapsulate sending events to the input transport."""
+        await self.publisher.publish(message_body)
 
     async def event_ready(self):
         """Called when the bot has successfully connected to Twitch."""
         logger.info(f"Bot is ready. Logged in as {self.nick}")
+        # The next reconnect logs in with the stored token, so it must still be valid by then
+        await self.refresh_token()
+        if self._started:
+            return  # Reconnected: the background tasks are still running
+        self._started = True
+        if self.user_tokens is not None:
+            asyncio.create_task(self.token_refresh_loop())
+        asyncio.create_task(self.lag_monitor.run())
+        self.publisher.start()
+        if self.allowlist is not None:
+            asyncio.create_task(self.allowlist.refresh_loop())
         # Start polling chatters
-        asyncio.create_task(self.poll_chatters())
+        for poller in self.pollers.values():
+            asyncio.create_task(self.poll_chatters(poller))
+        if self.snapshot is not None:
+            asyncio.create_task(self.snapshot_loop())
 
     async def event_message(self, message):
-        """Called when a message is received in the channel."""
-        logger.info(f"Received message from {message.author.name}: {message.content}")
+        """Called when a message is received in a channel."""
         if message.echo:
             return  # Ignore bot's own messages
+        channel = message.channel.name.lower() if message.channel else self.home_channel
+        event_log.info("Received message from %s in %s", message.author.name, channel,
+                       extra=logs.fields(event_type='message', username=message.author.name, channel=channel))
+        event_log.debug("Message content from %s: %s", message.author.name, message.content,
+                        extra=logs.fields(username=message.author.name, channel=channel))
+        poller = self.pollers.get(channel)
+        if poller is not None:
+            poller.activity_detected = True  # Mark activity as detected only in relevant context
+            poller.activity.set()
+        if self.allowlist is not None and self.allowlist.is_allowed(message.author.name, channel):
+            return  # Nothing downstream would happen to an allowed user
 
-        message_data = {
+        message_data = metrics.start_trace({
             'event_type': 'message',
+            'channel': channel,
             'username': message.author.name,
             'message': message.content,
+            'message_id': message.tags.get('id') if message.tags else None,
             'timestamp': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-        }
-        self.send_to_sqs(message_data)
-        self.activity_detected = True  # Mark activity as detected only in relevant context
+        })
+        await self.send_event(message_data)
 
-    async def poll_chatters(self):
-        """Poll chatters API and send join events to SQS with dynamic polling intervals."""
-        logger.info("Starting chatters polling...")
+    @property
+    def known_users(self):
+        return set().union(*(poller.chatters.known for poller in self.pollers.values()))
+
+    async def send_join(self, username, channel=None):
+        channel = channel or self.home_channel
+        if self.allowlist is not None and self.allowlist.is_allowed(username, channel):
+            return
+        join_event = metrics.start_trace({
+            'event_type': 'join',
+            'channel': channel,
+            'username': username,
+            'timestamp': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        })
+        await self.send_event(join_event)
+
+    async def poll_chatters(self, poller):
+        """Poll the chatters of a channel and send join events with adaptive polling intervals."""
+        logger.info(f"Starting chatters polling for {poller.name}...")
+        on_join = functools.partial(self.send_join, channel=poller.name)
         while True:
             try:
-                response = await self.twitch.get_chatters(self.channel_id)
-                current_users = {chatter['user_name'] for chatter in response.get('data', [])}
-                new_users = current_users - self.known_users
-                users_left = self.known_users - current_users
-
-                # Send join events for new users
-                for new_user in new_users:
-                    join_event = {
-                        'event_type': 'join',
-                        'username': new_user,
-                        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-                    }
-                    self.send_to_sqs(join_event)
-                    self.activity_detected = True  # Mark activity only for relevant events
-
-                # Adjust polling interval based on activity
-                if new_users or users_left or self.activity_detected:
-                    self.poll_interval = 30  # High activity, poll frequently
+                joined, parted = await poller.chatters.sync(self.twitch, self.channels[poller.name], self.channel_id,
+                                                            on_join)
+                logger.info(f"Chatters of {poller.name} synced: {len(poller.chatters.known)} present, "
+                            f"{joined} joined, {parted} left.")
+
+                # Adjust polling interval based on activity: drop quickly, back off gradually
+                if joined or parted or poller.activity_detected:
+                    poller.poll_interval = max(POLL_INTERVAL_MIN, poller.poll_interval / (4 if joined else 2))
                 else:
-                    self.poll_interval = 7200  # Low activity, poll every 2 hours
+                    poller.poll_interval = min(POLL_INTERVAL_MAX, poller.poll_interval * POLL_BACKOFF)
 
-                self.activity_detected = False  # Reset activity flag
-                self.known_users = current_users  # Update known users
+                poller.activity_detected = False  # Reset activity flag
 
             except Exception as e:
-                logger.error(f"Error polling chatters: {e}")
-
-            logger.info(f"Polling interval set to {self.poll_interval} seconds.")
-            await asyncio.sleep(self.poll_interval)  # Dynamic sleep interval based on activity
-
-    async def fetch_channel_id(self, channel_name):
-        """Fetch the channel ID for the given channel name."""
-        async for user_info in self.twitch.get_users(logins=[channel_name]):
-            if user_info:
-                logger.info(f"Found channel ID for {channel_name}: {user_info.id}")
-                return user_info.id
-        raise Exception(f"Channel {channel_name} not found.")
+                logger.error(f"Error polling chatters of {poller.name}: {e}")
+
+            logger.info(f"Polling interval of {poller.name} set to {poller.poll_interval:.0f} seconds.")
+            # Chat activity during a long quiet interval triggers an early poll
+            poller.activity.clear()
+            try:
+                await asyncio.wait_for(poller.activity.wait(), poller.poll_interval)
+                await asyncio.sleep(POLL_INTERVAL_MIN)
+            except asyncio.TimeoutError:
+                pass
+
+    def snapshot_state(self):
+        state = {
+            'channels': dict(self.channels),
+            'known_chatters': {name: list(poller.chatters.known) for name, poller in self.pollers.items()}
+        }
+        if self.allowlist is not None:
+            state['allowlist'] = self.allowlist.state()
+        return state
+
+    def restore(self, state):
+        """Resume from a snapshot, so the first chatters sync only reports chatters who joined meanwhile."""
+        self.channels.update(state.get('channels', {}))
+        known_chatters = state.get('known_chatters', {})
+        if isinstance(known_chatters, list):
+            known_chatters = {self.home_channel: known_chatters}  # Snapshot from before multi-channel support
+        for name, logins in known_chatters.items():
+            if name in self.pollers:
+                self.pollers[name].chatters.known = {sys.intern(login) for login in logins}
+        if self.allowlist is not None:
+            self.allowlist.restore(state.get('allowlist', []))
+        logger.info(f"Restored {len(self.known_users)} known chatters from snapshot.")
+
+    def set_token(self, token):
+        """Log in to IRC with `token` from the next connection on."""
+        # twitchio keeps the token on its websocket connection and logs in with it again on every reconnect
+        self._connection._token = token
+        self._http.token = token
+
+    async def refresh_token(self):
+        """Refresh the user token if it is near expiry; returns whether it is valid."""
+        if self.user_tokens is None:
+            return True
+        token = self.user_tokens['access_token']
+        try:
+            new_token = await refresh_token_if_needed(self.user_tokens, self.config_collection)
+            if new_token != token:
+                self.set_token(new_token)
+                await self.twitch.set_user_authentication(new_token, USER_SCOPES, self.user_tokens['refresh_token'])
+                logger.info("IRC token refreshed.")
+        except Exception as e:
+            logger.error(f"Error refreshing the IRC token: {e}")
+            return False
+        return True
+
+    async def token_refresh_loop(self):
+        """Refresh the user token shortly before it expires."""
+        while True:
+            await asyncio.sleep(refresh_delay(self.user_tokens))
+            if not await self.refresh_token():
+                await asyncio.sleep(TOKEN_RETRY_INTERVAL)
+
+    async def snapshot_loop(self):
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            await run_blocking(self.snapshot.save, self.snapshot_state())
+
+    async def fetch_channel_ids(self, channel_names):
+        """Fetch the ids of the given channels with a single get_users call."""
+        channel_ids = {}
+        async for user_info in self.twitch.get_users(logins=list(channel_names)):
+            logger.info(f"Found channel ID for {user_info.login}: {user_info.id}")
+            channel_ids[user_info.login] = user_info.id
+        missing = set(channel_names) - set(channel_ids)
+        if missing:
+            raise Exception(f"Channels not found: {', '.join(sorted(missing))}")
+        return channel_ids
+
+def get_ssm_parameters():
+    """Fetch parameters from AWS SSM."""
+    logger.info("Fetching SSM parameters...")
+    ssm = boto3.client('ssm', region_name='eu-west-1')
+    parameter_names = [
+        '/patroliaaws/input_queue_url',
+        '/patroliamongodb/connection_string'
+    ]
+    try:
+        response = ssm.get_parameters(
+            Names=parameter_names,
+            WithDecryption=True
+        )
+        params = {param['Name']: param['Value'] for param in response['Parameters']}
+        logger.info(f"SSM Parameters fetched: {list(params.keys())}")
+        return params
+    except Exception as e:
+        logger.error(f"Error fetching SSM parameters: {e}")
+        raise
+
+def get_twitch_credentials(config_collection):
+    """Fetch Twitch credentials and bot configuration from MongoDB."""
+    user_tokens = config_collection.find_one({'_id': 'twitch_user_tokens'})
+    if not user_tokens:
+        logger.error("Twitch user tokens not found in MongoDB.")
+        raise Exception("Twitch user tokens not found in MongoDB.")
+
+    bot_config = config_collection.find_one({'_id': 'bot_config'})
+    if not bot_config:
+        logger.error("Bot configuration not found in MongoDB.")
+        raise Exception("Bot configuration not found in MongoDB.")
+
+    logger.info("Fetched Twitch credentials and bot configuration successfully.")
+    return user_tokens, bot_config
+
+async def create_bot(db, transport, snapshot=None, state=None):
+    """Build the bot for the configured channels, with the Helix client used for the chatters lists.
+
+    The bot resumes from `state` when given, and saves its state to `snapshot`.
+    """
+    user_tokens, bot_config = await run_blocking(get_twitch_credentials, db['config'])
+    access_token = await refresh_token_if_needed(user_tokens, db['config'])
+    home_channel = bot_config['channel_name'].lower()
+    channels = configured_channels(bot_config)
+
+    bot = Patrolia(
+        token=access_token,
+        client_id=user_tokens['client_id'],
+        nick=bot_config['channel_name'],
+        prefix='!',
+        initial_channels=channels,
+        transport=transport,
+        allowed_users_collection=db['allowed_users']
+    )
+    bot.snapshot = snapshot
+    bot.user_tokens = user_tokens
+    bot.config_collection = db['config']
+    if state:
+        bot.restore(state)
+
+    # Only the user token is used, so no app token is fetched
+    bot.twitch = await Twitch(user_tokens['client_id'], user_tokens['client_secret'], authenticate_app=False)
+    await bot.twitch.set_user_authentication(access_token, USER_SCOPES, user_tokens['refresh_token'])
+    # The token belongs to the bot's own channel, which moderates every channel
+    wanted = [home_channel] + channels
+    missing = [name for name in dict.fromkeys(wanted) if name not in bot.channels]
+    if missing:
+        bot.channels.update(await bot.fetch_channel_ids(missing))
+    bot.channels = {name: bot.channels[name] for name in dict.fromkeys(wanted)}
+    bot.channel_id = bot.channels[home_channel]
+    logger.info(f"Moderating {len(channels)} channels: {', '.join(channels)}")
+    return bot
+
+async def main():
+    """Connect the bot to the configured channels."""
+    logger.info("Starting event poller...")
+    metrics.serve(METRICS_PORT)
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    snapshot = Snapshot('event_poller')
+    bot = None
+    try:
+        # The snapshot is read from disk while SSM is queried
+        ssm_params, state = await asyncio.gather(run_blocking(get_ssm_parameters), run_blocking(snapshot.load))
+        input_queue_url = ssm_params.get('/patroliaaws/input_queue_url')
+        mongo_connection_string = ssm_params['/patroliamongodb/connection_string']
+
+        logger.info("Connecting to MongoDB...")
+        mongo_client = MongoClient(mongo_connection_string)
+        db = mongo_client['patrolia']
+
+        transport = [open_shard_transport(INPUT_TRANSPORT, input_queue_url, shard) for shard in range(SHARD_COUNT)]
+        logger.info(f"Publishing to transport: {INPUT_TRANSPORT} ({SHARD_COUNT} shards)")
+        bot = await create_bot(db, transport, snapshot, state)
+        await bot.start()
+    except asyncio.CancelledError:
+        logger.info("Shutdown requested, flushing buffered events...")
+    except Exception as e:
+        logger.error(f"Error in main process: {e}")
+    finally:
+        if bot is not None:
+            await bot.publisher.close()
+            snapshot.save(bot.snapshot_state())
+
+if __name__ == '__main__':
+    asyncio.run(main())
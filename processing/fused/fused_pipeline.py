@@ -0,0 +1,84 @@
+import os
+import sys
+import signal
+import asyncio
+import logging
+
+# The stages sit next to this file in the image and in sibling directories in the repository
+_here = os.path.dirname(os.path.abspath(__file__))
+for _path in ('..', '../event_poller', '../eligibility_processor', '../action_handler'):
+    sys.path.append(os.path.normpath(os.path.join(_here, _path)))
+
+from pymongo import MongoClient
+from common.transport import open_transport
+from common import metrics, logs
+from common.aio import run_blocking
+from common.snapshot import Snapshot
+logs.setup('fused')  # Before the stages, which would otherwise configure logging under their own name
+import event_poller
+import eligibility_processor
+import action_handler
+
+logger = logging.getLogger()
+
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9100'))  # One endpoint for all three stages
+
+async def main():
+    """Run event_poller, eligibility_processor and action_handler in one process.
+
+    Events travel through in-memory transports instead of SQS, removing both
+    queue hops and their long polls from the message-to-timeout path.
+    """
+    logger.info("Starting fused pipeline...")
+    metrics.serve(METRICS_PORT)
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, main_task.cancel)
+
+    pool = allowlist = bot = None
+    snapshots = {name: Snapshot(name) for name in ('event_poller', 'eligibility_processor', 'action_handler')}
+    try:
+        # The stage snapshots are read from disk while SSM is queried
+        ssm_params, *states = await asyncio.gather(
+            run_blocking(action_handler.get_ssm_parameters),
+            *[run_blocking(snapshot.load) for snapshot in snapshots.values()]
+        )
+        poller_state, eligibility_state, handler_state = [state or {} for state in states]
+        mongo_connection_string = ssm_params['/patroliamongodb/connection_string']
+
+        logger.info("Connecting to MongoDB...")
+        mongo_client = MongoClient(mongo_connection_string)
+        db = mongo_client['patrolia']
+
+        input_transport = open_transport('memory:input')
+        output_transport = open_transport('memory:output')
+
+        # Eligibility runs on its consumer threads, the other two stages on this event loop
+        pool, allowlist = eligibility_processor.start(input_transport, output_transport, db['allowed_users'],
+                                                      eligibility_state)
+        (twitch, channel_id), bot = await asyncio.gather(
+            action_handler.connect_twitch(db['config'], handler_state.setdefault('channels', {})),
+            event_poller.create_bot(db, input_transport, snapshots['event_poller'], poller_state)
+        )
+
+        await asyncio.gather(
+            bot.start(),
+            action_handler.consume(output_transport, twitch, channel_id, snapshots['action_handler'], handler_state)
+        )
+    except asyncio.CancelledError:
+        logger.info("Shutdown requested, draining pipeline...")
+    except Exception as e:
+        logger.error(f"Error in main process: {e}")
+    finally:
+        if bot is not None:
+            await bot.publisher.close()
+            snapshots['event_poller'].save(bot.snapshot_state())
+        if pool is not None:
+            pool.drain(eligibility_processor.RECEIVE_WAIT_SECONDS)
+            allowlist.stop()
+            snapshots['eligibility_processor'].save({'allowlist': allowlist.entries()})
+        logger.info("Fused pipeline stopped.")
+
+if __name__ == '__main__':
+    asyncio.run(main())